@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+    ---------
+    
+    Offline benchmarks for Flask-Fragment.
+    
+    Run them from the repository root, e.g. ``python -m benchmark.roundtrips``.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
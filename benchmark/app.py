@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.app
+    -------------
+
+    Synthetic application modeled on `demo/ssiblog.py`.
+
+    It has the same fragments, tags and page layout, but views return
+    bodies pre-rendered from the demo templates instead of querying DB, so
+    only the extension itself and the memcached transport are measured.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import flask
+from flask_fragment import Fragment
+from flask_fragment.ssi import SSIMiddleware
+from benchmark.codecs import render_samples
+
+INDEX_TEMPLATE = ("<html><body><div>{{ fragment('user_info', userid) }}</div>"
+                  "<div>{{ fragment('posts_list', page) }}</div>{{ widgets }}</body></html>")
+POST_TEMPLATE = ("<html><body><div>{{ fragment('user_info', userid) }}</div>"
+                 "<div>{{ fragment('post_show', post_id) }}</div>"
+                 "<div>{{ fragment('comments_list', post_id, 1) }}</div>{{ widgets }}</body></html>")
+
+
+def create_app(config=None, widgets=0, render_cost=0, samples=50, ssi=False):
+    """Returns app and its `Fragment` extension
+
+    Args:
+        config: Dict of app config values.
+        widgets: Number of extra cached fragments on every page.
+        render_cost: Seconds every fragment view sleeps, models DB queries.
+        samples: Number of distinct bodies of every fragment.
+        ssi: Wraps app by `SSIMiddleware`, so includes are resolved in-process.
+    """
+    app = flask.Flask(__name__)
+    app.config['FRAGMENT_CACHING'] = True
+    app.config.update(config or {})
+    fragment = Fragment(app)
+    bodies = dict((name, [value.decode('utf-8') for value in values])
+                  for name, values in render_samples(samples).items())
+
+    def body(name, num):
+        if render_cost:
+            time.sleep(render_cost)
+        values = bodies[name]
+        return values[int(num) % len(values)]
+
+    @fragment(app, cache=300)
+    def user_info(userid):
+        return body('user_info', userid)
+
+    @fragment(app, cache=300, tags=['posts'])
+    def posts_list(page):
+        return body('posts_list', page)
+
+    @fragment(app, cache=300)
+    def post_show(post_id):
+        return body('post_show', post_id)
+
+    @fragment(app, cache=300, tags=lambda post_id, page: ['comments:{0}'.format(post_id)])
+    def comments_list(post_id, page):
+        return body('comments_list', post_id)
+
+    @fragment(app, cache=300)
+    def widget(num):
+        return '<aside>widget {0}</aside>'.format(num)
+
+    widgets_template = ''.join("{{{{ fragment('widget', {0}) }}}}".format(N) for N in range(widgets))
+    index_template = INDEX_TEMPLATE.replace('{{ widgets }}', widgets_template)
+    post_template = POST_TEMPLATE.replace('{{ widgets }}', widgets_template)
+
+    @app.route('/posts/<int:page>')
+    def posts(page):
+        return flask.render_template_string(index_template, page=page, userid=page % 10)
+
+    @app.route('/post/<int:post_id>')
+    def post(post_id):
+        return flask.render_template_string(post_template, post_id=post_id, userid=post_id % 10)
+
+    if ssi:
+        app.wsgi_app = SSIMiddleware(app, fragment)
+    return app, fragment
+
+
+def page_urls(pages):
+    """Returns `pages` URLs of the app, index and post pages alternate."""
+    return [('/posts/{0}' if N % 2 else '/post/{0}').format(N//2+1) for N in range(pages)]
+
+
+def page_fragments(url):
+    """Returns (endpoint, args) of cached fragments of page `url`."""
+    kind, num = url.strip('/').split('/')
+    num = int(num)
+    if kind == 'posts':
+        return [('user_info', (num % 10,)), ('posts_list', (num,))]
+    return [('user_info', (num % 10,)), ('post_show', (num,)), ('comments_list', (num, 1))]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.codecs
+    ----------------
+    
+    Measures compression ratio and throughput of `Compressor` settings on
+    fragments rendered by templates of the demo application.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+import random
+import argparse
+import datetime
+import jinja2
+from flask_fragment.utilites import Compressor
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'demo', 'templates')
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis').split()
+
+
+class Record(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Pagination(object):
+    def __init__(self, page, pages):
+        self.page = page
+        self.pages = pages
+
+    def iter_pages(self):
+        for N in range(1, self.pages+1):
+            if N <= 2 or N > self.pages-2 or abs(N-self.page) <= 2:
+                yield N
+            elif N == 3 or N == self.pages-2:
+                yield None
+
+
+def text(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for N in range(words))
+
+
+def user(rnd):
+    return Record(id=rnd.randint(1, 1000), username='user{0}'.format(rnd.randint(1, 1000)),
+                  posts_count=rnd.randint(0, 100), comments_count=rnd.randint(0, 1000))
+
+
+def created_at(rnd):
+    return datetime.datetime(2013, 1, 1) + datetime.timedelta(seconds=rnd.randint(0, 10**7))
+
+
+def render_samples(count, seed=0):
+    """Renders `count` samples of every demo fragment, returns dict by endpoint."""
+    rnd = random.Random(seed)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES), autoescape=True)
+    env.globals['url_for'] = lambda endpoint, **kwargs: '/{0}/{1}'.format(
+        endpoint, '/'.join(str(value) for value in kwargs.values()))
+    samples = dict((name, []) for name in ('posts_list', 'comments_list', 'post_show', 'user_info'))
+    for N in range(count):
+        pagination = Pagination(rnd.randint(1, 30), 30)
+        posts = [Record(id=rnd.randint(1, 10**5), title=text(rnd, 5), author=user(rnd),
+                        comments_count=rnd.randint(0, 50), created_at=created_at(rnd))
+                 for M in range(20)]
+        samples['posts_list'].append(env.get_template('fragments/posts_list.html').render(
+            pagination=pagination, posts=posts))
+        comments = [Record(author=user(rnd), created_at=created_at(rnd), body=text(rnd, 30))
+                    for M in range(20)]
+        samples['comments_list'].append(env.get_template('fragments/comments_list.html').render(
+            pagination=pagination, comments=comments, post_id=rnd.randint(1, 10**5), page=1))
+        samples['post_show'].append(env.get_template('fragments/post_show.html').render(
+            post=Record(title=text(rnd, 5), body=text(rnd, 200))))
+        samples['user_info'].append(env.get_template('fragments/userinfo.html').render(
+            current_user=user(rnd)))
+    return dict((name, [value.encode('utf-8') for value in values]) for name, values in samples.items())
+
+
+def measure(compressor, samples, name):
+    raw = sum(len(value) for value in samples)
+    started = time.time()
+    packed = [compressor.pack(value, name) for value in samples]
+    compress_time = time.time()-started
+    started = time.time()
+    for value in packed:
+        compressor.unpack(value)
+    decompress_time = time.time()-started
+    size = sum(len(value)-len(compressor.packed_prefix) for value in packed)
+    mb = raw/1024.0/1024.0
+    return float(size)/raw, mb/compress_time, mb/decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--samples', type=int, default=400, help='samples per fragment')
+    parser.add_argument('--dictionary-size', type=int, default=16384)
+    args = parser.parse_args()
+    training = render_samples(args.samples, seed=1)
+    samples = render_samples(args.samples, seed=2)
+    dictionaries = dict((name, Compressor.train(values, args.dictionary_size))
+                        for name, values in training.items())
+    codecs = (('zlib level 1', Compressor(level=1)),
+              ('zlib default', Compressor()),
+              ('zlib level 9', Compressor(level=9)),
+              ('zlib + dictionary', Compressor(dictionaries=dictionaries)))
+    print('{0:>14} {1:>18} {2:>8} {3:>14} {4:>14}'.format(
+        'fragment', 'codec', 'ratio', 'compress MB/s', 'inflate MB/s'))
+    for name in sorted(samples):
+        average = sum(len(value) for value in samples[name]) // len(samples[name])
+        print('{0:>14} {1:>18}'.format(name, 'avg {0} bytes'.format(average)))
+        for codec, compressor in codecs:
+            ratio, compress, decompress = measure(compressor, samples[name], name)
+            print('{0:>14} {1:>18} {2:>8.3f} {3:>14.1f} {4:>14.1f}'.format(
+                '', codec, ratio, compress, decompress))
+
+
+if __name__ == '__main__':
+    main()
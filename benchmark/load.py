@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.load
+    --------------
+
+    Drives the synthetic application with concurrent page requests against
+    the memcached stand-in and reports throughput, latency percentiles and
+    memcached traffic per page.
+
+    Misses are produced by resetting fragments of a page before it is
+    requested, with probability `1 - hit ratio`, resets are timed apart.
+    Use `--json` to keep results and compare them across commits.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from benchmark.app import create_app, page_urls, page_fragments
+from benchmark.server import MemcachedServer
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values)*percent/100.0), len(values)-1)]
+
+
+def counters(endpoints, before):
+    """Returns per-endpoint counters collected since `before` snapshot."""
+    result = []
+    for endpoint, data in endpoints.items():
+        base = before.get(endpoint, {})
+        result.append(dict((name, data[name]-base.get(name, 0))
+                           for name in ('hits', 'stale', 'misses', 'renders')))
+    return result
+
+
+def worker(app, fragment, urls, requests, hit_ratio, seed, latencies, resets):
+    rnd = random.Random(seed)
+    client = app.test_client()
+    for N in range(requests):
+        url = rnd.choice(urls)
+        if rnd.random() >= hit_ratio:
+            started = time.time()
+            with app.test_request_context():
+                for endpoint, args in page_fragments(url):
+                    fragment.reset(endpoint, *args)
+            resets.append(time.time()-started)
+        started = time.time()
+        response = client.get(url)
+        latencies.append(time.time()-started)
+        assert response.status_code == 200, url
+
+
+def run(args):
+    server = MemcachedServer(latency=args.latency)
+    config = {
+        'FRAGMENT_MEMCACHED_SERVERS': [server.start()],
+        'FRAGMENT_BATCH': args.batch,
+        'FRAGMENT_PARALLEL': args.parallel,
+        'FRAGMENT_ASYNC': args.use_async,
+        'FRAGMENT_COMPRESS_BODIES': args.compress,
+        'FRAGMENT_TRACE': args.trace,
+        'FRAGMENT_MEMO': bool(args.l1),
+        'FRAGMENT_L1_SIZE': args.l1,
+    }
+    if args.shm:
+        config['FRAGMENT_STORAGE'] = 'shm'
+        config['FRAGMENT_SHM_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.shm')
+    app, fragment = create_app(config, widgets=args.widgets, render_cost=args.render_cost,
+                               ssi=args.ssi or args.compress or args.shm)
+    urls = page_urls(args.pages)
+    client = app.test_client()
+    for url in urls:
+        client.get(url)
+    with app.app_context():
+        warm = fragment.stats.snapshot()['endpoints']
+    server.reset_stats()
+
+    latencies, resets, threads = [], [], []
+    requests = args.requests // args.concurrency
+    started = time.time()
+    for N in range(args.concurrency):
+        thread = threading.Thread(target=worker, args=(app, fragment, urls, requests,
+                                                       args.hit_ratio, N, latencies, resets))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    seconds = time.time()-started
+    server.stop()
+    if args.shm:
+        for name in (config['FRAGMENT_SHM_PATH'], config['FRAGMENT_SHM_PATH']+'.lock'):
+            os.unlink(name)
+        os.rmdir(os.path.dirname(config['FRAGMENT_SHM_PATH']))
+
+    with app.app_context():
+        endpoints = counters(fragment.stats.snapshot()['endpoints'], warm)
+    lookups = sum(data['hits']+data['stale']+data['misses'] for data in endpoints)
+    pages = len(latencies)
+    return {
+        'pages': pages,
+        'seconds': seconds,
+        'pages_per_second': pages/seconds,
+        'p50_ms': percentile(latencies, 50)*1000,
+        'p99_ms': percentile(latencies, 99)*1000,
+        'reset_p50_ms': percentile(resets, 50)*1000,
+        'commands_per_page': float(server.commands)/pages,
+        'roundtrips_per_page': float(server.roundtrips)/pages,
+        'renders_per_page': float(sum(data['renders'] for data in endpoints))/pages,
+        'hit_ratio': float(sum(data['hits'] for data in endpoints))/lookups if lookups else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100, help='number of distinct pages')
+    parser.add_argument('--widgets', type=int, default=5, help='extra fragments per page')
+    parser.add_argument('--requests', type=int, default=2000, help='total page requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads')
+    parser.add_argument('--hit-ratio', type=float, default=0.9, help='share of pages not reset')
+    parser.add_argument('--render-cost', type=float, default=0.002, help='seconds per fragment view')
+    parser.add_argument('--latency', type=float, default=0.0002, help='memcached round trip seconds')
+    parser.add_argument('--batch', action='store_true', help='sets FRAGMENT_BATCH')
+    parser.add_argument('--parallel', action='store_true', help='sets FRAGMENT_PARALLEL')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='sets FRAGMENT_ASYNC')
+    parser.add_argument('--ssi', action='store_true', help='assembles pages by SSIMiddleware')
+    parser.add_argument('--compress', action='store_true',
+                        help='sets FRAGMENT_COMPRESS_BODIES, implies --ssi')
+    parser.add_argument('--shm', action='store_true',
+                        help='sets FRAGMENT_STORAGE to shared memory, implies --ssi')
+    parser.add_argument('--l1', type=int, default=0,
+                        help='sets FRAGMENT_L1_SIZE in bytes and FRAGMENT_MEMO')
+    parser.add_argument('--trace', type=float, default=0, help='sets FRAGMENT_TRACE sampling rate')
+    parser.add_argument('--json', action='store_true', help='prints result as JSON')
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        result['options'] = vars(args)
+        print(json.dumps(result, sort_keys=True))
+        return
+    for name in ('pages', 'seconds', 'pages_per_second', 'p50_ms', 'p99_ms', 'reset_p50_ms',
+                 'commands_per_page', 'roundtrips_per_page', 'renders_per_page', 'hit_ratio'):
+        print('{0:>20} {1:>12.3f}'.format(name, result[name]))
+
+
+if __name__ == '__main__':
+    main()
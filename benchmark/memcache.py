@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.memcache
+    ------------------
+    
+    In-process memcache stand-in that counts network round trips.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import threading
+
+
+class CountingMemcache(object):
+    """Dict based object that implements memcache interface
+    
+    Every call counts as one round trip, the same as for real client.
+    """
+    def __init__(self):
+        self.data = {}
+        self.roundtrips = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is not None:
+            value, expire_at = item
+            if not expire_at or expire_at > time.time():
+                return value
+            del self.data[key]
+        return None
+
+    def _set(self, key, value, timeout):
+        self.data[key] = (value, time.time()+timeout if timeout else 0)
+
+    def _count(self):
+        self.roundtrips += 1
+
+    def get(self, key):
+        with self._lock:
+            self._count()
+            return self._get(key)
+
+    def get_multi(self, keys):
+        with self._lock:
+            self._count()
+            values = ((key, self._get(key)) for key in keys)
+            return dict((key, value) for key, value in values if value is not None)
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            self._count()
+            self._set(key, value, time)
+            return True
+
+    def set_multi(self, mappings, time=0):
+        with self._lock:
+            self._count()
+            for key, value in mappings.items():
+                self._set(key, value, time)
+            return []
+
+    def add(self, key, value, time=0):
+        with self._lock:
+            self._count()
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, time)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._count()
+            return self.data.pop(key, None) is not None
+
+    def delete_multi(self, keys):
+        with self._lock:
+            self._count()
+            for key in keys:
+                self.data.pop(key, None)
+            return True
+
+    def incr(self, key, value):
+        with self._lock:
+            self._count()
+            current = self._get(key)
+            if current is None:
+                return None
+            self.data[key] = (int(current)+value, self.data[key][1])
+            return int(current)+value
+
+    def decr(self, key, value):
+        return self.incr(key, -value)
+
+    def pipeline(self, ops):
+        """Executes commands as one round trip, like quiet binary requests."""
+        with self._lock:
+            self._count()
+            for op in ops:
+                if op[0] == 'set':
+                    self._set(op[1], op[2], op[3])
+                elif op[0] == 'delete':
+                    self.data.pop(op[1], None)
+                elif op[0] == 'incr' and self._get(op[1]) is not None:
+                    self.data[op[1]] = (int(self._get(op[1]))+op[2], self.data[op[1]][1])
+            return []
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.pipeline
+    ------------------
+    
+    Compares sequential and pipelined quiet memcached commands for the cache
+    write path and bulk reset against the binary protocol stand-in.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import argparse
+import bmemcached
+from functools import partial
+from flask_fragment.utilites import MemcachePool, Compressor
+from benchmark.server import MemcachedServer
+
+
+def write_sequential(pool, url, body):
+    pool.set('fragment:'+url, body, 480)
+    pool.set('fragment:fresh:'+url, (int(time.time())+300, ()), 480)
+    pool.delete('fragment:lock:'+url)
+
+
+def write_pipelined(pool, url, body):
+    pool.pipeline([
+        ('set', 'fragment:'+url, body, 480),
+        ('set', 'fragment:fresh:'+url, (int(time.time())+300, ()), 480),
+        ('delete', 'fragment:lock:'+url)])
+
+
+def reset_sequential(pool, urls):
+    for url in urls:
+        pool.delete('fragment:fresh:'+url)
+
+
+def reset_pipelined(pool, urls):
+    pool.pipeline([('delete', 'fragment:fresh:'+url) for url in urls])
+
+
+def measure(server, func, *args):
+    server.reset_stats()
+    started = time.time()
+    func(*args)
+    return time.time()-started, server.roundtrips
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fragments', type=int, default=200, help='fragments written')
+    parser.add_argument('--urls', type=int, default=5000, help='URLs reset at once')
+    parser.add_argument('--latency', type=float, default=0.0002, help='round trip seconds')
+    args = parser.parse_args()
+
+    server = MemcachedServer(latency=args.latency)
+    pool = MemcachePool(partial(bmemcached.Client, servers=[server.start()],
+                                compression=Compressor()))
+    body = Compressor.unless_prefix + b'<p>fragment</p>' * 100
+    urls = ['/_inc/posts_list/{0}'.format(N) for N in range(args.urls)]
+    pool.get('warmup')
+
+    print('{0:>28} {1:>12} {2:>12}'.format('case', 'seconds', 'round trips'))
+    for name, func in (('write burst, sequential', write_sequential),
+                       ('write burst, pipelined', write_pipelined)):
+        def writes():
+            for url in urls[:args.fragments]:
+                func(pool, url, body)
+        seconds, roundtrips = measure(server, writes)
+        print('{0:>28} {1:>12.4f} {2:>12}'.format(name, seconds, roundtrips))
+    for name, func in (('bulk reset, sequential', reset_sequential),
+                       ('bulk reset, pipelined', reset_pipelined)):
+        seconds, roundtrips = measure(server, func, pool, urls)
+        print('{0:>28} {1:>12.4f} {2:>12}'.format(name, seconds, roundtrips))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.roundtrips
+    --------------------
+    
+    Counts memcached round trips per page with and without `FRAGMENT_BATCH`.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import argparse
+import flask
+from flask_fragment import Fragment
+from benchmark.memcache import CountingMemcache
+
+
+def create_app(fragments, batch):
+    app = flask.Flask(__name__)
+    app.config['FRAGMENT_CACHING'] = True
+    app.config['FRAGMENT_BATCH'] = batch
+    fragment = Fragment(app)
+
+    @fragment(app, cache=300)
+    def item(num):
+        return '<p>Fragment #{0}</p>'.format(num)
+
+    template = ''.join("{{{{ fragment('item', {0}) }}}}".format(N) for N in range(fragments))
+
+    @app.route('/')
+    def index():
+        return flask.render_template_string(template)
+
+    memcache = CountingMemcache()
+    app.extensions['fragment']['memcache'] = memcache
+    return app, memcache
+
+
+def measure(fragments, pages, batch):
+    app, memcache = create_app(fragments, batch)
+    client = app.test_client()
+    client.get('/')
+    cold = memcache.roundtrips
+    memcache.roundtrips = 0
+    for N in range(pages):
+        client.get('/')
+    return cold, float(memcache.roundtrips) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fragments', type=int, default=15, help='fragments per page')
+    parser.add_argument('--pages', type=int, default=100, help='number of warm pages')
+    args = parser.parse_args()
+    print('{0:>10} {1:>16} {2:>16}'.format('mode', 'cold page', 'warm page'))
+    for batch in (False, True):
+        cold, warm = measure(args.fragments, args.pages, batch)
+        print('{0:>10} {1:>16} {2:>16.1f}'.format('batch' if batch else 'serial', cold, warm))
+
+
+if __name__ == '__main__':
+    main()
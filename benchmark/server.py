@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.server
+    ----------------
+    
+    Memcached stand-in that speaks the binary protocol.
+    
+    It implements commands used by the extension and bmemcached (get, set,
+    add, delete, incr and their quiet versions, noop, version, flush) and
+    can add artificial latency to model network round trip.
+    
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import struct
+import asyncio
+import threading
+
+HEADER = struct.Struct('!BBHBBHIIQ')
+
+GET, SET, ADD, REPLACE, DELETE, INCR, DECR, QUIT, FLUSH = range(0x00, 0x09)
+GETQ, NOOP, VERSION, GETK, GETKQ = range(0x09, 0x0e)
+SETQ, ADDQ, REPLACEQ, DELETEQ, INCRQ, DECRQ, QUITQ, FLUSHQ = range(0x11, 0x19)
+
+QUIET = {GETQ: GET, GETKQ: GETK, SETQ: SET, ADDQ: ADD, REPLACEQ: REPLACE,
+         DELETEQ: DELETE, INCRQ: INCR, DECRQ: DECR, QUITQ: QUIT, FLUSHQ: FLUSH}
+
+SUCCESS, NOT_FOUND, EXISTS, NOT_STORED, NON_NUMERIC, UNKNOWN = 0x00, 0x01, 0x02, 0x05, 0x06, 0x81
+
+MESSAGES = {NOT_FOUND: b'Not found', EXISTS: b'Data exists for key.',
+            NOT_STORED: b'Not stored.', UNKNOWN: b'Unknown command',
+            NON_NUMERIC: b'Non-numeric server-side value for incr or decr'}
+
+# relative expiration times are limited by 30 days, like in memcached
+RELATIVE_EXPIRE_LIMIT = 60*60*24*30
+
+
+class MemcachedServer(object):
+    """Memcached binary protocol stand-in running in background thread
+    
+    Args:
+        host: Host to listen.
+        port: Port to listen, 0 means any free port.
+        latency: Seconds added before every response burst.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.data = {}
+        self.cas = 0
+        self.commands = 0
+        self.roundtrips = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return '{0}:{1}'.format(self.host, self.port)
+
+    def start(self):
+        """Starts server, returns its address."""
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self.address
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop.stop()
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._thread.join()
+        self._loop.close()
+
+    def reset_stats(self):
+        self.commands = 0
+        self.roundtrips = 0
+
+    async def _handle(self, reader, writer):
+        buffer = b''
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                responses = []
+                quit = False
+                while len(buffer) >= HEADER.size:
+                    header = HEADER.unpack_from(buffer)
+                    size = HEADER.size + header[6]
+                    if len(buffer) < size:
+                        break
+                    body, buffer = buffer[HEADER.size:size], buffer[size:]
+                    response = self._execute(header, body)
+                    if response is not None:
+                        responses.append(response)
+                    if header[1] in (QUIT, QUITQ):
+                        quit = True
+                        break
+                if responses:
+                    self.roundtrips += 1
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    writer.write(b''.join(responses))
+                    await writer.drain()
+                if quit:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _execute(self, header, body):
+        magic, opcode, keylen, extlen, datatype, vbucket, bodylen, opaque, cas = header
+        extras, key, value = body[:extlen], body[extlen:extlen+keylen], body[extlen+keylen:]
+        quiet = opcode in QUIET
+        command = QUIET.get(opcode, opcode)
+        self.commands += 1
+        status, extras, key, value, cas = self._command(command, extras, key, value, cas)
+        if quiet and (status == SUCCESS) != (command in (GET, GETK)):
+            # quiet get answers only hits, quiet mutation answers only failures
+            return None
+        if status != SUCCESS:
+            extras, key, value = b'', b'', MESSAGES.get(status, b'')
+        return HEADER.pack(0x81, opcode, len(key), len(extras), 0, status,
+                           len(extras)+len(key)+len(value), opaque, cas) + extras + key + value
+
+    def _command(self, command, extras, key, value, cas):
+        if command in (GET, GETK):
+            item = self._get(key)
+            if item is None:
+                return NOT_FOUND, b'', b'', b'', 0
+            flags, value, expire_at, cas = item
+            return SUCCESS, struct.pack('!I', flags), key if command == GETK else b'', value, cas
+        if command in (SET, ADD, REPLACE):
+            flags, expire = struct.unpack('!II', extras)
+            item = self._get(key)
+            if command == ADD and item is not None:
+                return EXISTS, b'', b'', b'', 0
+            if command == REPLACE and item is None:
+                return NOT_FOUND, b'', b'', b'', 0
+            if cas and (item is None or item[3] != cas):
+                return EXISTS, b'', b'', b'', 0
+            return SUCCESS, b'', b'', b'', self._set(key, flags, value, expire)
+        if command == DELETE:
+            if self.data.pop(key, None) is None:
+                return NOT_FOUND, b'', b'', b'', 0
+            return SUCCESS, b'', b'', b'', 0
+        if command in (INCR, DECR):
+            delta, initial, expire = struct.unpack('!QQI', extras)
+            item = self._get(key)
+            if item is None:
+                if expire == 0xFFFFFFFF:
+                    return NOT_FOUND, b'', b'', b'', 0
+                counter, flags = initial, 0
+            else:
+                flags, counter = item[0], item[1]
+                if not counter.isdigit():
+                    return NON_NUMERIC, b'', b'', b'', 0
+                counter = int(counter)
+                counter = counter+delta if command == INCR else max(counter-delta, 0)
+                expire = None
+            counter &= 0xFFFFFFFFFFFFFFFF
+            cas = self._set(key, flags, str(counter).encode(), expire)
+            return SUCCESS, b'', b'', struct.pack('!Q', counter), cas
+        if command == FLUSH:
+            self.data.clear()
+            return SUCCESS, b'', b'', b'', 0
+        if command in (NOOP, QUIT):
+            return SUCCESS, b'', b'', b'', 0
+        if command == VERSION:
+            return SUCCESS, b'', b'', b'1.6.0-standin', 0
+        return UNKNOWN, b'', b'', b'', 0
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is not None and item[2] and item[2] <= time.time():
+            del self.data[key]
+            return None
+        return item
+
+    def _set(self, key, flags, value, expire):
+        if expire is None:
+            # keeps expiration time of existing item
+            expire_at = self.data[key][2]
+        elif not expire:
+            expire_at = 0
+        elif expire <= RELATIVE_EXPIRE_LIMIT:
+            expire_at = time.time()+expire
+        else:
+            expire_at = expire
+        self.cas += 1
+        self.data[key] = (flags, value, expire_at, self.cas)
+        return self.cas
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Memcached binary protocol stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    parser.add_argument('--latency', type=float, default=0, help='seconds per response burst')
+    args = parser.parse_args()
+    server = MemcachedServer(args.host, args.port, args.latency)
+    print('Listening on {0}'.format(server.start()))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
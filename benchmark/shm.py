@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.shm
+    -------------
+
+    Compares shared memory store with memcached: microseconds per call of
+    commands used by `fragment()` and total operations per second of
+    several forked worker processes sharing the store.
+
+    Memcached is the binary protocol stand-in unless `--server` gives the
+    address of real one, which is the fair comparison.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+import random
+import timeit
+import argparse
+import tempfile
+import bmemcached
+import multiprocessing
+from functools import partial
+from flask_fragment.shm import SharedMemoryStore
+from flask_fragment.utilites import MemcachePool, Compressor
+from benchmark.server import MemcachedServer
+
+BODY = b'<!--INC--><ul>' + b'<li><a href="/post/1">Post title</a></li>'*40 + b'</ul>'
+
+
+def cases(store):
+    fresh = (int(time.time())+300, (), 0.01)
+    store.set('fragment:/_inc/hit', BODY, 600)
+    store.set('fragment:fresh:/_inc/hit', fresh, 600)
+    keys = ['fragment:fresh:/_inc/hit']*5 + ['fragment:fresh:/_inc/miss']*5
+    return (('get fresh key', lambda: store.get('fragment:fresh:/_inc/hit')),
+            ('get body', lambda: store.get('fragment:/_inc/hit')),
+            ('get missing', lambda: store.get('fragment:fresh:/_inc/miss')),
+            ('get_multi 10 keys', lambda: store.get_multi(keys)),
+            ('set fresh key', lambda: store.set('fragment:fresh:/_inc/hit', fresh, 600)),
+            ('add + delete lock', lambda: (store.add('fragment:lock:/_inc/hit', 1, 180),
+                                           store.delete('fragment:lock:/_inc/hit'))))
+
+
+def mixed(factory, seconds, keys, count):
+    """Reads fresh keys, missing ones and every 20th read are followed
+    by store, adds number of operations to `count`."""
+    store = factory()
+    rnd = random.Random(os.getpid())
+    stop = time.time()+seconds
+    operations = 0
+    while time.time() < stop:
+        for N in range(100):
+            key = 'fragment:fresh:/_inc/{0}'.format(rnd.randrange(keys))
+            if store.get(key) is None or N % 20 == 0:
+                store.set(key, (int(time.time())+300, (), 0.01), 600)
+                operations += 1
+            operations += 1
+    with count.get_lock():
+        count.value += operations
+
+
+def throughput(factory, processes, seconds, keys):
+    count = multiprocessing.Value('l', 0)
+    workers = [multiprocessing.Process(target=mixed, args=(factory, seconds, keys, count))
+               for N in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return count.value/seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--processes', type=int, default=4, help='forked workers')
+    parser.add_argument('--seconds', type=float, default=3, help='seconds of throughput test')
+    parser.add_argument('--keys', type=int, default=10000, help='distinct keys of throughput test')
+    parser.add_argument('--server', default=None, help='address of real memcached')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in round trip seconds')
+    args = parser.parse_args()
+    server = None
+    address = args.server
+    if address is None:
+        server = MemcachedServer(latency=args.latency)
+        address = server.start()
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.shm')
+    backends = (
+        ('shm', partial(SharedMemoryStore, path, size=32*1024*1024)),
+        ('memcached', partial(MemcachePool, partial(bmemcached.Client, servers=[address],
+                                                    compression=Compressor(min_size=256)))))
+    try:
+        print('{0:>20} {1:>12} {2:>12}'.format('us / call', *[name for name, factory in backends]))
+        results = [[(name, timeit.timeit(func, number=args.calls)/args.calls*10**6)
+                    for name, func in cases(factory())] for backend, factory in backends]
+        for row in zip(*results):
+            print('{0:>20} {1:>12.1f} {2:>12.1f}'.format(row[0][0], *[value for name, value in row]))
+        print('{0:>20} {1:>12.0f} {2:>12.0f}'.format(
+            'ops / s, {0} procs'.format(args.processes),
+            *[throughput(factory, args.processes, args.seconds, args.keys)
+              for name, factory in backends]))
+    finally:
+        if server is not None:
+            server.stop()
+        for name in (path, path+'.lock'):
+            os.unlink(name)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.stampede
+    ------------------
+
+    Counts backend renders of one hot fragment per expiry under concurrent
+    load, for every `FRAGMENT_LOCK_POLICY` with and without early refresh.
+
+    Pages are assembled by `SSIMiddleware`, so a missing body is rendered
+    by a subrequest to the fragment URL, the same as nginx falls back to
+    backend. Scenario `expire` lets the fragment go stale by its timeout,
+    scenario `evict` drops its body and fresh keys like memcached eviction.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import argparse
+import threading
+import flask
+from flask_fragment import Fragment
+from flask_fragment.ssi import SSIMiddleware
+from benchmark.server import MemcachedServer
+from benchmark.load import percentile
+
+
+def create_app(server, timeout, render_cost, config):
+    app = flask.Flask(__name__)
+    app.config['FRAGMENT_CACHING'] = True
+    app.config['FRAGMENT_MEMCACHED_SERVERS'] = [server]
+    app.config.update(config)
+    fragment = Fragment(app)
+    renders = [0]
+
+    @fragment(app, cache=timeout)
+    def hot(num):
+        renders[0] += 1
+        time.sleep(render_cost)
+        return '<p>hot fragment {0}</p>'.format(num)
+
+    @app.route('/')
+    def index():
+        return flask.render_template_string("<html>{{ fragment('hot', 1) }}</html>")
+
+    app.wsgi_app = SSIMiddleware(app, fragment)
+    return app, fragment, renders
+
+
+def measure(args, scenario, config):
+    server = MemcachedServer(latency=args.latency)
+    timeout = args.timeout if scenario == 'expire' else 3600
+    app, fragment, renders = create_app(server.start(), timeout, args.render_cost, config)
+    app.test_client().get('/')
+    renders[0] = 0
+    stop = time.time()+args.duration
+    latencies = []
+
+    def client():
+        client = app.test_client()
+        while time.time() < stop:
+            started = time.time()
+            client.get('/')
+            latencies.append(time.time()-started)
+
+    threads = [threading.Thread(target=client) for N in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    with app.app_context():
+        memcache = fragment.memcache
+        stores = fragment.stats.snapshot()['endpoints']['hot']['stores']
+    expiries = 0
+    if scenario == 'expire':
+        time.sleep(args.duration)
+    else:
+        while time.time()+args.interval < stop:
+            time.sleep(args.interval)
+            memcache.delete_multi([fragment.body_prefix+'/_inc/hot/1',
+                                   fragment.fresh_prefix+'/_inc/hot/1'])
+            expiries += 1
+    for thread in threads:
+        thread.join()
+    server.stop()
+    if scenario == 'expire':
+        # every expiry is stored once by the request that won the lock
+        with app.app_context():
+            expiries = fragment.stats.snapshot()['endpoints']['hot']['stores']-stores
+    return float(renders[0])/max(expiries, 1), percentile(latencies, 99)*1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--duration', type=float, default=6, help='seconds per case')
+    parser.add_argument('--timeout', type=int, default=2, help='fragment cache timeout')
+    parser.add_argument('--interval', type=float, default=1, help='seconds between evictions')
+    parser.add_argument('--render-cost', type=float, default=0.05, help='seconds per render')
+    parser.add_argument('--latency', type=float, default=0.0002, help='memcached round trip seconds')
+    args = parser.parse_args()
+    print('{0:>8} {1:>8} {2:>14} {3:>18} {4:>10}'.format(
+        'scenario', 'policy', 'early refresh', 'renders / expiry', 'p99 ms'))
+    for scenario in ('expire', 'evict'):
+        for policy in ('stale', 'wait', 'inline'):
+            for beta in (0, 1.0):
+                config = {'FRAGMENT_LOCK_POLICY': policy, 'FRAGMENT_EARLY_REFRESH': beta}
+                renders, p99 = measure(args, scenario, config)
+                print('{0:>8} {1:>8} {2:>14} {3:>18.2f} {4:>10.1f}'.format(
+                    scenario, policy, 'on' if beta else 'off', renders, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark.urls
+    --------------
+
+    Measures cost of building fragment URL and of the whole `fragment()`
+    template call on cache hit: `url_for` against the precompiled builder,
+    with and without `FRAGMENT_URL_MEMO`.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import timeit
+import argparse
+import flask
+from flask_fragment import Fragment
+from benchmark.memcache import CountingMemcache
+
+
+def create_app(memo):
+    app = flask.Flask(__name__)
+    app.config['FRAGMENT_CACHING'] = True
+    app.config['FRAGMENT_BATCH'] = True
+    app.config['FRAGMENT_URL_MEMO'] = memo
+    fragment = Fragment(app)
+
+    @fragment(app, cache=300)
+    def comments_list(post_id, page):
+        return ''
+
+    app.extensions['fragment']['memcache'] = CountingMemcache()
+    return app, fragment, comments_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--values', type=int, default=100, help='distinct argument values')
+    parser.add_argument('--strings', action='store_true', help='non-ASCII string values')
+    args = parser.parse_args()
+    print('{0:>28} {1:>12}'.format('case', 'us / call'))
+    for name, memo, case in (('url_for', 0, 'url_for'),
+                             ('builder', 0, 'url'),
+                             ('builder + memo', 1024, 'url'),
+                             ('fragment(), url_for', 0, 'call_url_for'),
+                             ('fragment(), builder', 0, 'call'),
+                             ('fragment(), builder + memo', 1024, 'call')):
+        app, fragment, view = create_app(memo)
+        values = [N % args.values for N in range(args.calls)]
+        if args.strings:
+            values = [u'статья-{0}'.format(value) for value in values]
+        with app.test_request_context('/'):
+            ctx = flask._request_ctx_stack.top
+            if case == 'url_for':
+                func = lambda value: flask.url_for('comments_list', post_id=value, page=1)
+            elif case == 'url':
+                func = lambda value: fragment._url('comments_list', view, {'post_id': value, 'page': 1})
+            else:
+                if case == 'call_url_for':
+                    fragment._url = lambda endpoint, func, kwargs: flask.url_for(endpoint, **kwargs)
+                def func(value):
+                    fragment._fragment_tmpl_func('comments_list', value, 1)
+                    ctx._fragment_pending = None
+            iterator = iter(values)
+            seconds = timeit.timeit(lambda: func(next(iterator)), number=args.calls)
+        print('{0:>28} {1:>12.2f}'.format(name, seconds/args.calls*10**6))
+
+
+if __name__ == '__main__':
+    main()
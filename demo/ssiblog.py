@@ -78,7 +78,7 @@ def user_info(userid):
     return render_template('fragments/userinfo.html')
 
 
-@fragment(app, cache=300)
+@fragment(app, cache=300, depends_on=[Post, Comment])
 def posts_list(page):
     page = int(page)
     page_size = POSTS_ON_PAGE
@@ -87,12 +87,11 @@ def posts_list(page):
     return render_template('fragments/posts_list.html', pagination=pagination, posts=posts)
 
 
-@fragment.resethandler(posts_list)
-def reset_posts_list():
-    page_size = POSTS_ON_PAGE
-    pagination = Post.query.filter_by().paginate(1, page_size)
-    for N in range(pagination.pages):
-        fragment.reset_url(url_for('posts_list', page=N+1))
+@fragment.warmup_args(posts_list)
+def posts_list_pages():
+    # the first page is shown even without posts
+    pages = (Post.query.count()+POSTS_ON_PAGE-1)//POSTS_ON_PAGE
+    return range(1, max(pages, 1)+1)
 
 
 @app.route('/posts/<int:page>')
@@ -109,7 +108,7 @@ def post_show(post_id):
     return render_template('fragments/post_show.html', post=post)
 
 
-@fragment(app, cache=300)
+@fragment(app, cache=300, depends_on=[Comment.post_id])
 def comments_list(post_id, page):
     page = int(page)
     page_size = COMMENTS_ON_PAGE
@@ -119,12 +118,10 @@ def comments_list(post_id, page):
                                                            pagination=pagination, comments=comments)
 
 
-@fragment.resethandler(comments_list)
-def reset_comments_list(post_id):
-    page_size = COMMENTS_ON_PAGE
-    pagination = Comment.query.filter_by(post_id=post_id).paginate(1, page_size)
-    for N in range(pagination.pages):
-        fragment.reset_url(url_for('comments_list', post_id=post_id, page=N+1))
+@fragment.warmup_args(comments_list)
+def comments_list_pages():
+    for post in Post.query.all():
+        yield post.id, 1
 
 
 @app.route('/post/<int:post_id>/<int:page>', methods=['GET', 'POST'])
@@ -135,9 +132,7 @@ def post(post_id, page):
         form.comment.post_id = post_id
         db.session.add(form.comment)
         db.session.commit()
-        fragment.reset(posts_list)
-        fragment.reset(comments_list, post_id)
-        fragment.reset(user_info, current_user.id)
+        fragment.reset(user_info, current_user.id, refresh=True)
         flash('Your comment has saved successfully.', 'info')
     return render_template('post.html', form=form, post_id=post_id, page=page)
 
@@ -152,8 +147,7 @@ def new_post():
         form.post.author_id = current_user.id
         db.session.add(form.post)
         db.session.commit()
-        fragment.reset(posts_list)
-        fragment.reset(user_info, current_user.id)
+        fragment.reset(user_info, current_user.id, refresh=True)
         flash('Your post has saved successfully.', 'info')
         return redirect(url_for('index'))
     return render_template('newpost.html', form=form)
@@ -191,6 +185,13 @@ def nginx_conf():
     file_name = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'nginx.conf')
     fragment._create_nginx_config(file_name)
     
+@manager.option('-p', '--processes', dest='processes', type=int, default=4)
+@manager.option('-r', '--rate', dest='rate', type=float, default=None)
+def warmup(processes, rate):
+    """Pre-renders cached fragments into memcached."""
+    from flask.ext.fragment.warmup import print_progress
+    fragment.warmup(processes=processes, rate=rate, progress=print_progress)
+
 @manager.command
 def create_db():
     """Creates application DB."""
@@ -8,14 +8,48 @@
     :copyright: (c) 2013 by Alexey Poryadin.
     :license: MIT, see LICENSE for more details.
 """
+import re
+import math
+import time
+import hashlib
+import random
 import flask
 import jinja2
 import inspect
+import threading
 from functools import partial
+from collections import deque
 from flask import Flask, Blueprint
 from flask import _app_ctx_stack as stack
-from flask_fragment.utilites import Compressor
+from flask import _request_ctx_stack as request_stack
+from werkzeug.exceptions import HTTPException
+from flask_fragment.utilites import Compressor, WorkerPool, LRUCache, pipeline, subrequest_environ
+from flask_fragment.utilites import memcached_servers, split_html
 from flask_fragment.utilites import BMemcache as Memcache
+from flask_fragment.stats import Stats, timer, send
+from flask_fragment.stats import fragment_hit, fragment_miss, fragment_lock
+from flask_fragment.stats import fragment_rendered, fragment_stored, fragment_reset, fragment_traced
+from flask_fragment.trace import NO_SPAN
+
+# States of cached fragment
+FRESH, STALE, MISSING = 'fresh', 'stale', 'missing'
+
+# Marks WSGI environ of request context created for background thread
+WORKER_ENVIRON_KEY = 'flask_fragment.worker'
+
+# Carries trace and parent span of page to request context of worker thread
+TRACE_ENVIRON_KEY = 'flask_fragment.trace'
+
+# `async def` views are supported by Flask 2.0+ on Python 3.5+
+iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+
+# Room for prefix and zlib overhead of body chunk
+CHUNK_OVERHEAD = 64
+
+PLACEHOLDER_RE = re.compile(r'<!--fragment:pending:\d+-->')
+
+# Stands for view argument while URL template is built
+URL_ARG_RE = re.compile(r'fragmentarg(\d+)x')
 
 
 class Fragment(object):
@@ -23,54 +57,266 @@ class Fragment(object):
     body_prefix = 'fragment:'
     lock_prefix = 'fragment:lock:'
     fresh_prefix = 'fragment:fresh:'
+    tag_prefix = 'fragment:tag:'
+    epoch_key = 'fragment:epoch'
 
     def __init__(self, app=None):
         self.app = app
+        self._lock = threading.Lock()
         if app is not None:
             self.init_app(app)
 
 
-    def __call__(self, mod, cache=None, resethandler=None):
+    def __call__(self, mod, cache=None, resethandler=None, tags=None, warmup=None, depends_on=None):
         """Decorator to define function as fragment cached view
         
         Args:
             mod: Flask app or blueprint
             cache: The cache timeout value or None if not need to cache.
+            tags: List of tags or function that accepts view arguments and
+                returns list of tags. All fragments marked by tag are reset
+                at once by `reset_tag`.
+            warmup: Function that returns arguments to warm up, see `warmup_args`.
+            depends_on: List of SQLAlchemy models and columns, fragments are
+                reset when a transaction that changed them commits, see
+                `flask_fragment.sqla.Invalidator`.
         """
         def decorator(fragment_view):
             endpoint = fragment_view.__name__
             fragment_view.cache_timeout = cache
             fragment_view.cache_endpoint = endpoint
             fragment_view.cache_resethandler = resethandler
+            fragment_view.cache_tags = tags
+            fragment_view.cache_warmup = warmup
             if isinstance(mod, Blueprint):
                 rule = '/_inc/{0}.{1}'.format(mod.name, endpoint)
             else:
                 rule = '/_inc/{0}'.format(endpoint)
             fragment_view.args_names = list(inspect.getargspec(fragment_view).args)
+            fragment_view.cache_depends = None
+            if depends_on:
+                fragment_view.cache_depends = self._invalidator.watch(depends_on, fragment_view.args_names)
             for arg_name in fragment_view.args_names:
                 rule += '/<{0}>'.format(arg_name)
-            mod.add_url_rule(rule, endpoint, fragment_view)
+            def fragment_route(**kwargs):
+                return self._serve(fragment_view, kwargs)
+            fragment_route.fragment_view = fragment_view
+            mod.add_url_rule(rule, endpoint, fragment_route)
             return fragment_view
         return decorator
     
 
     def init_app(self, app):
         self.app = app
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['fragment'] = {}
         # injects `fragment` function to the context of templates
         self.app.context_processor(lambda: {'fragment': self._fragment_tmpl_func})
+        # checks fragments collected in batched mode before response is sent
+        self.app.after_request(self._after_request)
+        # serves chunks of large fragments evicted from memcached
+        app.add_url_rule('/_inc/_chunk/<token>/<int:number>/<path:url>', 'fragment_chunk',
+                         self._serve_chunk)
+        # exposes metrics if `FRAGMENT_STATS_URL` is set
+        stats_url = app.config.get('FRAGMENT_STATS_URL')
+        if stats_url:
+            app.add_url_rule(stats_url, 'fragment_stats', self.stats_view)
+        # exposes recent traces if `FRAGMENT_TRACE_URL` is set
+        trace_url = app.config.get('FRAGMENT_TRACE_URL')
+        if trace_url:
+            app.add_url_rule(trace_url, 'fragment_traces', self.trace_view)
+        # asyncio client cannot authenticate, it fails here rather than miss every lookup
+        if app.config.get('FRAGMENT_ASYNC') and app.config.get('FRAGMENT_CACHING'):
+            from flask_fragment.aio import check_config
+            check_config(app.config)
+        # adds `flask fragment-warmup` command
+        if getattr(app, 'cli', None) is not None:
+            from flask_fragment.warmup import register_cli
+            register_cli(app, self)
 
 
     @property
     def memcache(self):
-        """Returns memcache object or None if fragment caching disabled."""
+        """Returns memcache object or None if fragment caching disabled.
+        
+        Memcache object is a connection pool shared by all threads of the
+        process, it is created on first use when app config is complete.
+        If `FRAGMENT_STORAGE` is `'shm'` it is shared memory of the host.
+        If `FRAGMENT_L1_SIZE` is set it is fronted by per-process cache.
+        """
         ctx = stack.top
         if ctx is not None:
-            if not hasattr(ctx, '_fragment_memcache'):
-                ctx._fragment_memcache = Memcache(ctx, flask.current_app.config)
-            return ctx._fragment_memcache
+            state = ctx.app.extensions['fragment']
+            if 'memcache' not in state:
+                with self._lock:
+                    if 'memcache' not in state:
+                        factory = Memcache
+                        if ctx.app.config.get('FRAGMENT_STORAGE') == 'shm':
+                            from flask_fragment.shm import ShmMemcache as factory
+                        memcache = factory(ctx.app, ctx.app.config)
+                        if memcache is not None and ctx.app.config.get('FRAGMENT_L1_SIZE'):
+                            from flask_fragment.l1 import L1Memcache
+                            memcache = state['l1'] = L1Memcache(
+                                memcache, ctx.app.config['FRAGMENT_L1_SIZE'],
+                                ttl=ctx.app.config.get('FRAGMENT_L1_TTL', 2),
+                                max_item=ctx.app.config.get('FRAGMENT_L1_MAX_ITEM', 4096),
+                                epoch_key=self.epoch_key, exclude=(self.lock_prefix,),
+                                fresh_prefix=self.fresh_prefix)
+                        state['memcache'] = memcache
+            return state['memcache']
+        return None
+
+    @property
+    def _memcache(self):
+        """Returns memcache object whose commands are recorded in trace of
+        current request. It is for commands only, must not be kept."""
+        memcache = self.memcache
+        trace = getattr(request_stack.top, '_fragment_trace', None)
+        if trace and memcache is not None:
+            return trace.wrap(memcache)
+        return memcache
+
+
+    @property
+    def compressor(self):
+        """Returns compressor configured by `FRAGMENT_COMPRESS_*` values."""
+        ctx = stack.top
+        if ctx is not None:
+            state = ctx.app.extensions['fragment']
+            if 'compressor' not in state:
+                state['compressor'] = Compressor.from_config(ctx.app.config)
+            return state['compressor']
+        return None
+
+
+    @property
+    def refresher(self):
+        """Returns pool that regenerates stale fragments in background
+        or None if background regeneration disabled."""
+        ctx = stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_REFRESH'):
+            state = ctx.app.extensions['fragment']
+            if 'refresher' not in state:
+                config = ctx.app.config
+                drop = config.get('FRAGMENT_REFRESH_DROP', 'new')
+                with self._lock:
+                    if 'refresher' not in state:
+                        state['refresher'] = WorkerPool(
+                            workers=config.get('FRAGMENT_REFRESH_WORKERS', 2),
+                            queue_size=config.get('FRAGMENT_REFRESH_QUEUE_SIZE', 100),
+                            drop='old' if drop=='old' else 'new')
+            return state['refresher']
+        return None
+
+
+    @property
+    def _swapper(self):
+        """Returns pool that re-renders fragments reset with `refresh`."""
+        state = flask.current_app.extensions['fragment']
+        if 'swapper' not in state:
+            config = flask.current_app.config
+            with self._lock:
+                if 'swapper' not in state:
+                    state['swapper'] = WorkerPool(
+                        workers=config.get('FRAGMENT_REFRESH_WORKERS', 2),
+                        queue_size=config.get('FRAGMENT_REFRESH_QUEUE_SIZE', 100))
+        return state['swapper']
+
+
+    @property
+    def renderer(self):
+        """Returns pool that renders fragments of page concurrently
+        or None if parallel mode disabled or it is not page request.
+        
+        It is None after the view returned too, fragments rendered while
+        response is streamed cannot be spliced in place of placeholders.
+        """
+        ctx = request_stack.top
+        if (ctx is not None and ctx.app.config.get('FRAGMENT_PARALLEL')
+                and not ctx.request.environ.get(WORKER_ENVIRON_KEY)
+                and not getattr(ctx, '_fragment_responded', False)):
+            state = ctx.app.extensions['fragment']
+            if 'renderer' not in state:
+                config = ctx.app.config
+                with self._lock:
+                    if 'renderer' not in state:
+                        state['renderer'] = WorkerPool(
+                            workers=config.get('FRAGMENT_PARALLEL_WORKERS', 8),
+                            queue_size=config.get('FRAGMENT_PARALLEL_QUEUE_SIZE', 64))
+            return state['renderer']
         return None
     
 
+    @property
+    def stats(self):
+        """Returns metrics of the process or None if `FRAGMENT_STATS` is off."""
+        ctx = stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_STATS', True):
+            state = ctx.app.extensions['fragment']
+            if 'stats' not in state:
+                with self._lock:
+                    if 'stats' not in state:
+                        state['stats'] = Stats()
+            return state['stats']
+        return None
+
+
+    @property
+    def adaptive_ttl(self):
+        """Returns tuner of fragment timeouts of the process
+        or None if `FRAGMENT_ADAPTIVE_TTL` is off."""
+        ctx = stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_ADAPTIVE_TTL'):
+            state = ctx.app.extensions['fragment']
+            if 'adaptive_ttl' not in state:
+                from flask_fragment.ttl import AdaptiveTTL
+                with self._lock:
+                    if 'adaptive_ttl' not in state:
+                        state['adaptive_ttl'] = AdaptiveTTL.from_config(ctx.app.config)
+            return state['adaptive_ttl']
+        return None
+
+
+    @property
+    def url_memo(self):
+        """Returns memo of recently built fragment URLs
+        or None if `FRAGMENT_URL_MEMO` is not set."""
+        ctx = stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_URL_MEMO'):
+            state = ctx.app.extensions['fragment']
+            if 'url_memo' not in state:
+                with self._lock:
+                    if 'url_memo' not in state:
+                        state['url_memo'] = LRUCache(ctx.app.config['FRAGMENT_URL_MEMO'])
+            return state['url_memo']
+        return None
+
+
+    @property
+    def traces(self):
+        """Returns deque of recent traces of the process, its size is
+        `FRAGMENT_TRACE_KEEP`, default `20`."""
+        state = flask.current_app.extensions['fragment']
+        if 'traces' not in state:
+            with self._lock:
+                if 'traces' not in state:
+                    state['traces'] = deque(maxlen=flask.current_app.config.get('FRAGMENT_TRACE_KEEP', 20))
+        return state['traces']
+
+
+    @property
+    def _invalidator(self):
+        """Returns listener of SQLAlchemy sessions, it is created by the
+        first view with `depends_on`."""
+        if not hasattr(self, '_sqla_invalidator'):
+            from flask_fragment.sqla import Invalidator
+            with self._lock:
+                if not hasattr(self, '_sqla_invalidator'):
+                    self._sqla_invalidator = Invalidator(self)
+        return self._sqla_invalidator
+
+
     @property
     def lock_timeout(self):
         """Returns lock timeout. Default value 180."""
@@ -80,6 +326,16 @@ class Fragment(object):
                 ctx._fragment_lock_timeout = flask.current_app.config.get('FRAGMENT_LOCK_TIMEOUT', 180)
             return ctx._fragment_lock_timeout
         return None
+
+
+    @property
+    def chunk_size(self):
+        """Returns max size of stored body, larger ones are split to chunks.
+        Default is max value size of the storage or 1000 KB for memcached."""
+        size = flask.current_app.config.get('FRAGMENT_CHUNK_SIZE')
+        if size is None:
+            size = getattr(self.memcache, 'max_value_size', 1000*1024)
+        return size
     
     
     def resethandler(self, fragment_view):
@@ -90,16 +346,54 @@ class Fragment(object):
         return decorator        
 
 
+    def warmup_args(self, fragment_view):
+        """Decorator sets function that returns arguments to warm up `fragment_view`
+        
+        Function returns iterable of arguments sets, every set is a tuple
+        of positional arguments, a dict of keyword arguments or a single value.
+        """
+        def decorator(func):
+            fragment_view.cache_warmup = func
+            return func
+        return decorator
+
+
+    def warmup(self, endpoints=None, processes=4, rate=None, force=False, progress=None):
+        """Renders and stores fragments which have `warmup_args`
+        
+        It must be called within app context, fragments are rendered by
+        a pool of forked processes. See `flask_fragment.warmup.warmup`.
+        
+        Args:
+            endpoints: Endpoints to warm up, all if None.
+            processes: Number of processes, 0 renders in current process.
+            rate: Max number of fragments started per second.
+            force: Renders also fragments that are fresh.
+            progress: Function called with `done, total, url, status, error`.
+        
+        Returns:
+            Dict with number of fragments by status and list of failures.
+        """
+        from flask_fragment.warmup import warmup
+        return warmup(self, flask.current_app._get_current_object(), endpoints,
+                      processes, rate, force, progress)
+
+
     def reset(self, target, *args, **kwargs):
         """Resets cache for fragment cached view
         
         Args:
             target: Endpoint or the view itself.
+            refresh: Keyword argument, re-renders the fragment in background
+                instead of reset, see `reset_url`. It is not passed to
+                resethandler.
         """
+        refresh = kwargs.pop('refresh', False)
         if isinstance(target, str):
             fragment_view = flask.current_app.view_functions.get(target)
             if fragment_view is None:
                 raise ValueError('Not found view for endpoint "{0}"'.format(target))
+            fragment_view = fragment_view.fragment_view
         else:
             fragment_view = target
         if fragment_view.cache_resethandler is None:
@@ -112,19 +406,311 @@ class Fragment(object):
                 raise RuntimeError('Cannot reset cache for "{0}",'
                     ' resethandler is not set and default handler canot'
                     ' build URL. Detail: "{1}"'.format(fragment_view, exc))
-            self.reset_url(url)
+            self.reset_url(url, refresh)
         else:
             fragment_view.cache_resethandler(*args, **kwargs)
         
     
-    def reset_url(self, url):
+    def reset_url(self, url, refresh=False):
         """Resets cache for URL
         
         Args:
             url: URL value
+            refresh: Re-renders the fragment in background and stores it over
+                the old one instead of reset, so readers keep getting the old
+                body until then rather than render it themselves. Falls back
+                to reset if the fragment is being rendered or the queue
+                (`FRAGMENT_REFRESH_QUEUE_SIZE`) is full.
+        """
+        if self.memcache:
+            fresh = self._fresh_urls([url])
+            if not (refresh and self._refresh_ahead(url)):
+                self._cache_reset(url)
+            self._count_resets(fresh)
+
+
+    def reset_urls(self, urls, refresh=False):
+        """Resets cache for many URLs at once
+        
+        Fresh keys are deleted with pipelined quiet requests, so thousands
+        of URLs cost a few round trips.
+        
+        Args:
+            urls: Iterable of URL values.
+            refresh: Re-renders fragments in background, see `reset_url`.
+        """
+        if self.memcache:
+            urls = list(urls)
+            fresh = self._fresh_urls(urls)
+            reset = [url for url in urls if not (refresh and self._refresh_ahead(url))]
+            pipeline(self._memcache, [('delete', self.fresh_prefix+url) for url in reset])
+            self._count_resets(fresh)
+
+
+    def reset_tag(self, *tags):
+        """Resets cache for all fragments marked by any of `tags`
+        
+        Every tag has generation counter and fragment is fresh only while
+        counters have the same values as when it was rendered, so reset
+        costs one `incr` per tag regardless of the number of URLs.
+        
+        Args:
+            tags: Tag names.
         """
         if self.memcache:
-            self._cache_reset(url)
+            pipeline(self._memcache, [('incr', self.tag_prefix+tag, 1) for tag in tags])
+            stats = self.stats
+            for tag in tags:
+                if stats is not None:
+                    stats.tag_reset(tag)
+                send(fragment_reset, endpoint=None, tag=tag)
+
+
+    def stats_view(self):
+        """View that returns metrics in Prometheus text format,
+        or as JSON if `format=json` is passed in query string."""
+        stats = self.stats
+        if stats is None:
+            flask.abort(404)
+        tuner = self.adaptive_ttl
+        l1 = flask.current_app.extensions['fragment'].get('l1')
+        if flask.request.args.get('format') == 'json':
+            snapshot = stats.snapshot()
+            if tuner is not None:
+                snapshot['ttl'] = tuner.snapshot()
+            if l1 is not None:
+                snapshot['l1'] = l1.snapshot()
+            return flask.jsonify(snapshot)
+        text = stats.prometheus()
+        if tuner is not None:
+            text += tuner.prometheus()
+        if l1 is not None:
+            text += l1.prometheus()
+        return flask.Response(text, mimetype='text/plain; version=0.0.4')
+
+
+    def trace_view(self):
+        """View that returns recent traces as JSON trees of spans, or in
+        Chrome trace event format if `format=chrome` is passed in query string."""
+        traces = list(self.traces)
+        if flask.request.args.get('format') == 'chrome':
+            events = []
+            for trace in traces:
+                events.extend(trace.chrome_events())
+            return flask.jsonify({'traceEvents': events, 'displayTimeUnit': 'ms'})
+        return flask.jsonify({'traces': [trace.to_dict() for trace in traces]})
+
+
+    def flush(self):
+        """Checks fragments collected by batched mode and prepares stale ones
+        
+        Freshness of all collected fragments is checked with one multi-get.
+        Fragments rendered while stale ones are prepared (nested fragments)
+        are collected again, so there is one multi-get per nesting level.
+        It is called automatically after request if `FRAGMENT_BATCH` is set.
+        If `FRAGMENT_ASYNC` is set fragments are prepared by `flush_async`.
+        """
+        ctx = request_stack.top
+        pending = getattr(ctx, '_fragment_pending', None)
+        if pending and ctx.app.config.get('FRAGMENT_ASYNC'):
+            self._async_loop.run(self.flush_async())
+            return
+        while pending:
+            ctx._fragment_pending = []
+            calls = dict()
+            for url, timeout, deferred_view in pending:
+                calls.setdefault(url, (timeout, deferred_view))
+            with self._span('flush', fragments=len(calls)):
+                states = self._cache_state_multi([(url, self._view_tags(deferred_view))
+                                                  for url, (timeout, deferred_view) in calls.items()])
+                renderer = self.renderer
+                tasks = []
+                for url, (timeout, deferred_view) in calls.items():
+                    args = (url, timeout, deferred_view, states[url])
+                    if renderer is not None and states[url] != FRESH:
+                        # stale fragments are prepared concurrently
+                        task = renderer.submit(None, self._in_context(url, self._cache_update, *args))
+                        if task:
+                            tasks.append((task, args))
+                            continue
+                    self._cache_update(*args)
+                deadline = time.time()+ctx.app.config.get('FRAGMENT_PARALLEL_TIMEOUT', 5)
+                for task, args in tasks:
+                    if not task.wait(max(deadline-time.time(), 0)) or task.error is not None:
+                        self._cache_update(*args)
+            pending = ctx._fragment_pending
+
+
+    def flush_async(self):
+        """Returns awaitable version of `flush` for async mode
+        
+        Freshness of all collected fragments is checked with one multi-get
+        of asyncio memcached client, stale ones are prepared concurrently by
+        `asyncio.gather`: `async def` views are awaited, others are called
+        by executor threads. `async def` page view may await it on its own
+        event loop, otherwise it is called by `flush` after request.
+        """
+        from flask_fragment import aio
+        ctx = request_stack.top
+        pending = getattr(ctx, '_fragment_pending', None)
+        ctx._fragment_pending = []
+        return aio.flush(self, ctx.app, self.async_memcache, ctx.request.environ, pending)
+
+
+    @property
+    def async_memcache(self):
+        """Returns asyncio memcached client or None if fragment caching disabled."""
+        ctx = stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_CACHING'):
+            state = ctx.app.extensions['fragment']
+            if 'async_memcache' not in state:
+                from flask_fragment.aio import AsyncMemcache, AsyncStore
+                memcache = self.memcache
+                loop = self._async_loop
+                with self._lock:
+                    if 'async_memcache' not in state:
+                        if ctx.app.config.get('FRAGMENT_STORAGE') == 'shm':
+                            state['async_memcache'] = AsyncStore(memcache)
+                        else:
+                            state['async_memcache'] = AsyncMemcache.from_config(ctx.app.config, loop)
+            return state['async_memcache']
+        return None
+
+
+    @property
+    def _async_loop(self):
+        """Returns event loop thread that runs `flush_async` for sync code."""
+        state = flask.current_app.extensions['fragment']
+        if 'loop' not in state:
+            from flask_fragment.aio import LoopThread
+            with self._lock:
+                if 'loop' not in state:
+                    state['loop'] = LoopThread()
+        return state['loop']
+
+
+    @property
+    def _memo(self):
+        """Returns dict of results of cached fragments called by current
+        request by URL or None if `FRAGMENT_MEMO` is off."""
+        ctx = request_stack.top
+        if ctx is not None and ctx.app.config.get('FRAGMENT_MEMO'):
+            if getattr(ctx, '_fragment_memo', None) is None:
+                ctx._fragment_memo = {}
+            return ctx._fragment_memo
+        return None
+
+
+    @property
+    def _pending(self):
+        """Returns list of fragments collected by batched or async mode
+        or None if both are disabled."""
+        ctx = request_stack.top
+        if ctx is not None and (ctx.app.config.get('FRAGMENT_BATCH') or ctx.app.config.get('FRAGMENT_ASYNC')):
+            if getattr(ctx, '_fragment_pending', None) is None:
+                ctx._fragment_pending = []
+            return ctx._fragment_pending
+        return None
+
+
+    @property
+    def _trace(self):
+        """Returns trace of current request or None if it is not traced
+        
+        Request is traced with probability `FRAGMENT_TRACE` (0 to 1, default
+        0), decided once by the first fragment call. Request context of
+        worker thread continues the trace of the page.
+        """
+        ctx = request_stack.top
+        if ctx is None:
+            return None
+        trace = getattr(ctx, '_fragment_trace', None)
+        if trace is None:
+            trace = False
+            parent = ctx.request.environ.get(TRACE_ENVIRON_KEY)
+            rate = ctx.app.config.get('FRAGMENT_TRACE')
+            if parent is not None:
+                trace, span = parent
+                trace.attach(span)
+            elif rate and random.random() < rate:
+                from flask_fragment.trace import Trace
+                trace = Trace(ctx.request.url, ctx.app.config.get('FRAGMENT_TRACE_PROFILE', False))
+            ctx._fragment_trace = trace
+        return trace or None
+
+    def _span(self, name, **attrs):
+        """Returns context manager of span of current trace, it is no-op
+        if request is not traced."""
+        trace = self._trace
+        if trace is None:
+            return NO_SPAN
+        return trace.span(name, **attrs)
+
+    def _annotate(self, **attrs):
+        trace = self._trace
+        if trace is not None:
+            trace.annotate(**attrs)
+
+
+    def _after_request(self, response):
+        self.flush()
+        request_stack.top._fragment_responded = True
+        if getattr(request_stack.top, '_fragment_placeholders', None):
+            if response.is_streamed:
+                raise RuntimeError('Fragments rendered in parallel mode cannot be spliced into '
+                                   'streamed response, render them within the stream')
+            response.set_data(self._splice(response.get_data(as_text=True)))
+        trace = getattr(request_stack.top, '_fragment_trace', None)
+        if trace and TRACE_ENVIRON_KEY not in flask.request.environ:
+            trace.finish()
+            self.traces.append(trace)
+            send(fragment_traced, trace=trace)
+        return response
+
+
+    def _splice(self, text):
+        """Replaces placeholders of fragments rendered concurrently by their
+        results, fragment that failed or timed out is rendered serially."""
+        placeholders = getattr(request_stack.top, '_fragment_placeholders', None)
+        if not placeholders:
+            return text
+        def result(match):
+            task, deadline, deferred_view = placeholders.pop(match.group(0), (None, 0, None))
+            if task is None:
+                return ''
+            if task.wait(max(deadline-time.time(), 0)) and task.error is None:
+                return task.result
+            return deferred_view()
+        count = 1
+        while count:
+            text, count = PLACEHOLDER_RE.subn(result, text)
+        return text
+
+
+    def _in_context(self, url, func, *args):
+        """Returns callable that runs `func` within new request context
+        
+        New context is a GET request to fragment `url` that carries the
+        headers of current request, the same as nginx passes to backend
+        for included fragment.
+        """
+        app = flask.current_app._get_current_object()
+        if flask.has_request_context():
+            environ = subrequest_environ(flask.request.environ, url)
+        else:
+            # e.g. reset by command or by SQLAlchemy commit out of request
+            environ = app.test_request_context(url).request.environ
+        environ[WORKER_ENVIRON_KEY] = True
+        trace = self._trace
+        if trace is not None:
+            environ[TRACE_ENVIRON_KEY] = (trace, trace.current())
+        def run():
+            with app.request_context(environ):
+                with self._span('worker', url=url):
+                    result = func(*args)
+                    self.flush()
+                return result
+        return run
 
 
     def _fragment_tmpl_func(self, endpoint, *args, **kwargs):
@@ -136,54 +722,583 @@ class Fragment(object):
         Args:
             endpoint: The endpoint name.
         """
-        func = flask.current_app.view_functions.get(endpoint)
+        func = getattr(flask.current_app.view_functions.get(endpoint), 'fragment_view', None)
         if func is not None:
             for N in range(0, len(args)):
                 kwargs[func.args_names[N]] = args[N]
-            url = flask.url_for(endpoint, **kwargs)
-            return self._render(url, func.cache_timeout, partial(func, **kwargs))
+            return self._render(self._url(endpoint, func, kwargs), func.cache_timeout, partial(func, **kwargs))
         raise ValueError('Not found view for endpoint "{0}"'.format(endpoint))
 
+    def _url(self, endpoint, func, kwargs):
+        """Builds URL of fragment, the same as `url_for` does but faster"""
+        ctx = request_stack.top
+        if ctx is None or len(kwargs) != len(func.args_names):
+            return flask.url_for(endpoint, **kwargs)
+        state = ctx.app.extensions['fragment']
+        script_root = ctx.request.script_root
+        memo = None
+        if ctx.app.config.get('FRAGMENT_URL_MEMO'):
+            memo = state.get('url_memo') or self.url_memo
+            try:
+                # 1, 1.0 and True are equal keys but their URLs differ
+                key = (endpoint, script_root) + tuple((type(kwargs[name]), kwargs[name])
+                                                      for name in func.args_names)
+                url = memo.get(key)
+            except (KeyError, TypeError):
+                # unknown or unhashable argument
+                memo = None
+            else:
+                if url is not None:
+                    return url
+        builders = state.get('url_builders')
+        if builders is None:
+            builders = state['url_builders'] = {}
+        builder = builders.get((endpoint, script_root))
+        if builder is None:
+            builder = builders[(endpoint, script_root)] = self._compile_url(ctx.app, endpoint, func)
+        try:
+            url = builder(kwargs)
+        except KeyError:
+            return flask.url_for(endpoint, **kwargs)
+        if memo is not None:
+            memo.set(key, url)
+        return url
+
+    def _compile_url(self, app, endpoint, func):
+        """Returns function that builds URL of fragment from view arguments
+        
+        URL template is built once by `url_for` with stand-ins of arguments,
+        so blueprint prefix and script root are kept, and values are quoted
+        by the converter the rule uses.
+        """
+        if any(app.url_default_functions.values()):
+            # URL defaults may change values, so URL has to be built every time
+            return lambda kwargs: flask.url_for(endpoint, **kwargs)
+        template = flask.url_for(endpoint, **dict(
+            (name, 'fragmentarg{0}x'.format(N)) for N, name in enumerate(func.args_names)))
+        parts = URL_ARG_RE.split(template)
+        texts = parts[0::2]
+        names = [func.args_names[int(N)] for N in parts[1::2]]
+        to_url = app.url_map.converters['default'](app.url_map).to_url
+        def build(kwargs):
+            url = texts[0]
+            for name, text in zip(names, texts[1:]):
+                value = kwargs[name]
+                # digits are never quoted
+                url += (str(value) if type(value) is int else to_url(value)) + text
+            return url
+        return build
+
 
     def _render(self, url, timeout, deferred_view):
-        if self.memcache and timeout:
-            if not self._cache_valid(url):
-                self._cache_prepare(url, timeout, deferred_view)
-            return jinja2.Markup('<!--# include virtual="{0}" -->'.format(url))
+        memo = self._memo
+        if memo is not None and url in memo:
+            self._count_memo_hit(deferred_view.func.cache_endpoint)
+            return memo[url]
+        with self._span('fragment', endpoint=deferred_view.func.cache_endpoint, url=url,
+                        args=deferred_view.keywords):
+            if self.memcache and timeout:
+                result = jinja2.Markup('<!--# include virtual="{0}" -->'.format(url))
+                pending = self._pending
+                if pending is not None:
+                    pending.append((url, timeout, deferred_view))
+                    self._annotate(mode='batched')
+                else:
+                    state = self._cache_state(url, self._view_tags(deferred_view))
+                    body = self._cache_update(url, timeout, deferred_view, state)
+                    if body is not None:
+                        result = jinja2.Markup(body)
+                if memo is not None:
+                    # only cached results are kept, placeholders of parallel mode are used once
+                    memo[url] = result
+                return result
+            renderer = self.renderer
+            if renderer is not None:
+                task = renderer.submit(None, self._in_context(url, self._call_view, deferred_view))
+                if task:
+                    ctx = request_stack.top
+                    if getattr(ctx, '_fragment_placeholders', None) is None:
+                        ctx._fragment_placeholders = {}
+                        ctx._fragment_placeholders_count = 0
+                    ctx._fragment_placeholders_count += 1
+                    placeholder = '<!--fragment:pending:{0}-->'.format(ctx._fragment_placeholders_count)
+                    deadline = time.time()+ctx.app.config.get('FRAGMENT_PARALLEL_TIMEOUT', 5)
+                    ctx._fragment_placeholders[placeholder] = (task, deadline, deferred_view)
+                    self._annotate(mode='parallel')
+                    return jinja2.Markup(placeholder)
+            return jinja2.Markup(self._splice(self._call_view(deferred_view)))
+
+    def _serve(self, fragment_view, kwargs):
+        """Serves fragment URL requested by nginx (or `SSIMiddleware`) because
+        body is missing in memcached, render is guarded by the render lock."""
+        deferred_view = partial(fragment_view, **kwargs)
+        timeout = fragment_view.cache_timeout
+        with self._span('serve', endpoint=fragment_view.cache_endpoint, url=flask.request.path,
+                        args=kwargs):
+            if not (self.memcache and timeout):
+                return self._call_view(deferred_view)
+            url = self._url(flask.request.endpoint, fragment_view, kwargs)
+            if flask.request.if_none_match:
+                # proxy cache in front of backend revalidates its copy, it is
+                # answered without calling view while the fragment is fresh;
+                # If-Modified-Since is not, nginx passes it from page request
+                fresh, generations = self._fresh_values([(url, self._view_tags(deferred_view))])[url]
+                if self._fresh_state(fresh, generations) == FRESH and len(fresh) > 4 \
+                        and flask.request.if_none_match.contains(fresh[3]):
+                    self._count_not_modified(deferred_view.func.cache_endpoint)
+                    response = self._http_response(b'', fresh[3], fresh[4], fresh[0])
+                    response.status_code = 304
+                    return response
+            body = self._cache_prepare(url, timeout, deferred_view)
+            if body is None and flask.current_app.config.get('FRAGMENT_LOCK_POLICY') == 'wait':
+                body = self._wait_body(url)
+            if body is None:
+                body = self._splice(self._call_view(deferred_view))
+            tuner = self.adaptive_ttl
+            if tuner is not None:
+                # proxy must not keep it longer than it is kept in memcached
+                timeout = tuner.current(fragment_view.cache_endpoint, timeout)
+            now = int(time.time())
+            return self._http_response(body, self._etag(body.encode('utf-8')), now, now+timeout)
+
+    def _http_response(self, body, etag, last_modified, stale_at):
+        """Returns response of fragment URL with validators, it may be
+        cached by proxy until the fragment becomes stale."""
+        response = flask.current_app.make_response(body)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        max_age = flask.current_app.config.get('FRAGMENT_HTTP_MAX_AGE')
+        if max_age is None:
+            max_age = max(int(stale_at-time.time()), 0)
+        response.cache_control.public = True
+        if max_age:
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    def _etag(self, body):
+        return hashlib.sha1(body).hexdigest()[:16]
+
+    def _view_tags(self, deferred_view):
+        tags = getattr(deferred_view.func, 'cache_tags', None)
+        if callable(tags):
+            tags = tags(**deferred_view.keywords)
+        tags = tuple(tags or ())
+        depends = getattr(deferred_view.func, 'cache_depends', None)
+        if depends:
+            tags += tuple(tag.format(**deferred_view.keywords) for tag in depends)
+        return tags
+
+    def _cache_state(self, url, tags=()):
+        if tags:
+            return self._cache_state_multi([(url, tags)])[url]
+        return self._fresh_state(self._memcache.get(self.fresh_prefix+url), ())
+
+    def _cache_state_multi(self, calls):
+        values = self._fresh_values(calls)
+        return dict((url, self._fresh_state(*values[url])) for url in values)
+
+    def _fresh_values(self, calls):
+        """Returns `{url: (fresh value, generations of tags)}` read by one multi-get."""
+        keys = set()
+        for url, tags in calls:
+            keys.add(self.fresh_prefix+url)
+            keys.update(self.tag_prefix+tag for tag in tags)
+        values = self._memcache.get_multi(list(keys))
+        result = dict()
+        for url, tags in calls:
+            generations = tuple(values.get(self.tag_prefix+tag) for tag in tags)
+            result[url] = (values.get(self.fresh_prefix+url), generations)
+        return result
+
+    def _fresh_state(self, value, generations):
+        # fresh key keeps the time when fragment becomes stale, generations
+        # of its tags, render time, ETag and Last-Modified of the body, it
+        # lives as long as the body does (see `_fresh_value`)
+        if not isinstance(value, tuple) or value[1] != generations or None in generations:
+            return MISSING
+        stale_at = value[0]
+        beta = flask.current_app.config.get('FRAGMENT_EARLY_REFRESH', 1.0)
+        if beta and len(value) > 2:
+            # probabilistic early expiration (XFetch): the closer stale time
+            # and the longer render, the more likely one request refreshes
+            # fragment before it expires for all of them
+            stale_at += value[2]*beta*math.log(1.0-random.random())
+        return FRESH if stale_at > time.time() else STALE
+
+    def _tag_generations(self, tags, url=None, endpoint=None):
+        """Returns current generations of tags, missing counters are created
+        
+        If `url` of fragment being stored is given and `adaptive_ttl` is on,
+        its fresh key is read by the same multi-get to count reset by tag of
+        the previous body (see `_count_invalidated`).
+        """
+        if not tags:
+            return ()
+        keys = [self.tag_prefix+tag for tag in tags]
+        fresh_key = self.fresh_prefix+url if url is not None and self.adaptive_ttl is not None else None
+        values = self._memcache.get_multi(keys+[fresh_key] if fresh_key else keys)
+        for key in keys:
+            if values.get(key) is None:
+                self._memcache.add(key, int(time.time()*1000), 0)
+                values[key] = self._memcache.get(key)
+        generations = tuple(values.get(key) for key in keys)
+        if fresh_key:
+            self._count_invalidated(endpoint, values.get(fresh_key), generations)
+        return generations
+
+    def _call_view(self, deferred_view):
+        """Calls fragment view and records its render time."""
+        started = timer()
+        with self._span('render', endpoint=deferred_view.func.cache_endpoint):
+            if iscoroutinefunction(deferred_view.func):
+                result = flask.current_app.ensure_sync(deferred_view.func)(**deferred_view.keywords)
+            else:
+                result = deferred_view()
+        self._count_render(deferred_view.func.cache_endpoint, timer()-started)
+        return result
+
+    def _count_render(self, endpoint, seconds):
+        stats = self.stats
+        if stats is not None:
+            stats.observe(endpoint, seconds)
+        tuner = self.adaptive_ttl
+        if tuner is not None:
+            tuner.observe_render(endpoint, seconds)
+        send(fragment_rendered, endpoint=endpoint, seconds=seconds)
+
+    def _count_state(self, url, endpoint, state):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, {FRESH: 'hits', STALE: 'stale', MISSING: 'misses'}[state])
+        tuner = self.adaptive_ttl
+        if tuner is not None:
+            tuner.observe_read(endpoint, state == FRESH)
+        if state == FRESH:
+            send(fragment_hit, endpoint=endpoint, url=url)
         else:
-            return jinja2.Markup(deferred_view())
+            send(fragment_miss, endpoint=endpoint, url=url, state=state)
+
+    def _count_lock(self, url, endpoint, acquired):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'lock_acquired' if acquired else 'lock_lost')
+        send(fragment_lock, endpoint=endpoint, url=url, acquired=acquired)
+        self._annotate(lock=acquired)
+
+    def _count_store(self, url, endpoint, size):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'stores')
+            stats.incr(endpoint, 'body_bytes', size)
+        tuner = self.adaptive_ttl
+        if tuner is not None:
+            tuner.observe_store(endpoint)
+        send(fragment_stored, endpoint=endpoint, url=url, size=size)
+        self._annotate(stored_bytes=size)
+
+    def _count_chunked(self, endpoint, chunks):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'chunked')
+            stats.incr(endpoint, 'chunks', chunks)
+        self._annotate(chunks=chunks)
+
+    def _count_chunk_miss(self, endpoint):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'chunk_misses')
+
+    def _count_not_modified(self, endpoint):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'not_modified')
+        self._annotate(not_modified=True)
+
+    def _count_memo_hit(self, endpoint):
+        stats = self.stats
+        if stats is not None:
+            stats.incr(endpoint, 'memo_hits')
+
+    def _fresh_urls(self, urls):
+        """Returns those of `urls` whose fragments are fresh, so their reset
+        is counted, or nothing if neither stats nor tuner nor receivers count."""
+        if (self.stats is None and self.adaptive_ttl is None
+                and not getattr(fragment_reset, 'receivers', None)):
+            return []
+        values = self._memcache.get_multi([self.fresh_prefix+url for url in urls])
+        now = time.time()
+        # the stale time of fragment being refreshed is 0, see `_refresh_ahead`
+        return [url for url in urls if isinstance(values.get(self.fresh_prefix+url), tuple)
+                and values[self.fresh_prefix+url][0] > now]
+
+    def _count_resets(self, urls):
+        if not urls:
+            return
+        stats = self.stats
+        tuner = self.adaptive_ttl
+        view_functions = flask.current_app.view_functions
+        for url in urls:
+            endpoint = self._url_endpoint(url, view_functions)
+            if stats is not None:
+                stats.incr(endpoint, 'resets')
+            if tuner is not None:
+                tuner.observe_reset(endpoint)
+            send(fragment_reset, endpoint=endpoint, url=url)
+
+    def _count_invalidated(self, endpoint, value, generations):
+        # fresh key kept with older generations of tags means that fragment
+        # was reset by tag before it expired; it is counted by the render
+        # that holds the lock, so once per store however many read it
+        if isinstance(value, tuple) and None not in generations and value[1] != generations:
+            self.adaptive_ttl.observe_reset(endpoint)
+
+    def _url_endpoint(self, url, view_functions):
+        """Returns `cache_endpoint` of fragment view of `url`, that labels
+        its hits and stores (blueprint views are not labelled by blueprint)."""
+        # the segment after `/_inc/` is the endpoint of the route, see `__call__`
+        name = url.split('/_inc/', 1)[-1].split('/', 1)[0]
+        fragment_view = getattr(view_functions.get(name), 'fragment_view', None)
+        return fragment_view.cache_endpoint if fragment_view is not None else name
+
+    def _cache_update(self, url, timeout, deferred_view, state):
+        endpoint = deferred_view.func.cache_endpoint
+        with self._span('update', endpoint=endpoint, url=url, state=state):
+            self._count_state(url, endpoint, state)
+            if state == STALE and self._refresh(url, timeout, deferred_view):
+                return
+            if state != FRESH:
+                if self._cache_prepare(url, timeout, deferred_view) is None and state == MISSING:
+                    return self._lock_lost(url, deferred_view)
+
+    def _refresh(self, url, timeout, deferred_view):
+        """Submits stale fragment to background refresh, returns
+        False if it must be refreshed within request."""
+        refresher = self.refresher if request_stack.top is not None else None
+        if refresher is None:
+            return False
+        task = self._in_context(url, self._cache_prepare, url, timeout, deferred_view)
+        return bool(refresher.submit(url, task)
+                    or flask.current_app.config.get('FRAGMENT_REFRESH_DROP') != 'inline')
+
+    def _lock_lost(self, url, deferred_view):
+        """Applies `FRAGMENT_LOCK_POLICY` when other request renders missing
+        fragment, returns body to put inline instead of include or None."""
+        config = flask.current_app.config
+        policy = config.get('FRAGMENT_LOCK_POLICY', 'stale')
+        if policy == 'inline' and self._pending is None:
+            return self._splice(self._call_view(deferred_view))
+        if policy in ('wait', 'inline'):
+            # include is already emitted in batched mode, so waiting is all we can do
+            tags = self._view_tags(deferred_view)
+            for N in self._polls():
+                if self._cache_state(url, tags) == FRESH:
+                    break
+        return None
 
-    def _cache_valid(self, url):
-        return bool(self.memcache.get(self.fresh_prefix+url) or False)
+    def _wait_body(self, url):
+        """Polls body stored by other request, returns it or None on timeout."""
+        for N in self._polls():
+            body = self._memcache.get(self.body_prefix+url)
+            if body is not None:
+                body = self.compressor.unpack(body)
+                if body.startswith(Compressor.unless_prefix):
+                    body = body[len(Compressor.unless_prefix):]
+                return body.decode('utf-8')
+        return None
+
+    def _polls(self):
+        config = flask.current_app.config
+        poll = config.get('FRAGMENT_LOCK_POLL', 0.05)
+        deadline = time.time()+config.get('FRAGMENT_LOCK_WAIT', 2)
+        while time.time() < deadline:
+            time.sleep(poll)
+            yield
     
     def _cache_reset(self, url):
-        self.memcache.delete(self.fresh_prefix+url)
-    
-    def _cache_prepare(self, url, timeout, deferred_view):
-        successed_lock = self.memcache.add(self.lock_prefix+url, 1, self.lock_timeout)
+        self._memcache.delete(self.fresh_prefix+url)
+
+    def _refresh_ahead(self, url):
+        """Takes render lock of fragment URL, marks the fragment stale and
+        queues its render, returns False if it has to be reset instead
+        
+        Readers see the fragment stale but cannot take the lock, so they
+        include the old body until the new one is stored over it, the fresh
+        key is stored after the body (see `_store_ops`). If the render never
+        ends, the stale fresh key expires with the lock.
+        """
+        script_root = flask.request.script_root if flask.has_request_context() else ''
+        fragment_view, kwargs = self._match_url(url[len(script_root):])
+        if fragment_view is None or not fragment_view.cache_timeout:
+            return False
+        memcache = self._memcache
+        if not memcache.add(self.lock_prefix+url, 1, self.lock_timeout):
+            # the render in progress may have read data before the change
+            return False
+        fresh = memcache.get(self.fresh_prefix+url)
+        if isinstance(fresh, tuple):
+            memcache.set(self.fresh_prefix+url, (0,)+fresh[1:], self.lock_timeout)
+        task = self._in_context(url, self._swap, url, fragment_view.cache_timeout,
+                                partial(fragment_view, **kwargs))
+        # locks do not let the same URL be queued twice
+        if self._swapper.submit(None, task):
+            return True
+        memcache.delete(self.lock_prefix+url)
+        return False
+
+    def _swap(self, url, timeout, deferred_view):
+        """Renders fragment locked by `_refresh_ahead` and stores it over the old one."""
+        try:
+            return self._cache_prepare(url, timeout, deferred_view, locked=True)
+        except Exception:
+            # the old body must not be served any longer
+            pipeline(self._memcache, [('delete', self.fresh_prefix+url),
+                                     ('delete', self.lock_prefix+url)])
+            raise
+
+    def _cache_prepare(self, url, timeout, deferred_view, locked=False):
+        """Renders and stores fragment, returns rendered body
+        or None if other request holds the render lock."""
+        successed_lock = locked or self._memcache.add(self.lock_prefix+url, 1, self.lock_timeout)
+        endpoint = deferred_view.func.cache_endpoint
+        self._count_lock(url, endpoint, bool(successed_lock))
         if successed_lock:
-            result = Compressor.unless_prefix+(deferred_view()).encode('utf-8')
-            self.memcache.set(self.body_prefix+url, result, timeout+self.lock_timeout)
-            self.memcache.set(self.fresh_prefix+url, 1, timeout)
-            self.memcache.delete(self.lock_prefix+url)
+            timeout = self._adapt_timeout(endpoint, timeout)
+            generations = self._tag_generations(self._view_tags(deferred_view), url, endpoint)
+            started = timer()
+            trace = self._trace
+            try:
+                if trace is not None:
+                    body = self._splice(trace.profiled(self._call_view, deferred_view))
+                else:
+                    body = self._splice(self._call_view(deferred_view))
+            except Exception:
+                # the next request must not wait out the lock to render it again
+                self._memcache.delete(self.lock_prefix+url)
+                raise
+            encoded = body.encode('utf-8')
+            fresh = self._fresh_value(timeout, generations, timer()-started, encoded)
+            chunks, ops = self._store_ops(url, endpoint, encoded, fresh, timeout)
+            if chunks:
+                # chunks are stored before the body that includes them
+                pipeline(self._memcache, chunks)
+            pipeline(self._memcache, ops)
+            self._count_store(url, endpoint, sum(len(op[2]) for op in chunks+ops[:1]))
+            return body
+        return None
+
+    def _adapt_timeout(self, endpoint, timeout):
+        """Returns timeout chosen by `adaptive_ttl` for fragment of view
+        with `cache` timeout, or the same timeout if it is off."""
+        tuner = self.adaptive_ttl
+        if tuner is None:
+            return timeout
+        timeout = tuner.ttl(endpoint, timeout)
+        self._annotate(ttl=timeout)
+        return timeout
+
+    def _store_ops(self, url, endpoint, body, fresh, timeout):
+        """Returns commands that store chunks of `body` and then body and
+        fresh key of fragment and release its lock
+        
+        Body larger than `chunk_size` is split to chunks named by its ETag,
+        stored body includes them, so nginx stitches it back. Chunks of
+        the previous body are not touched, they expire with it.
+        """
+        ttl = timeout+self.lock_timeout
+        result = self._encode_body(endpoint, body)
+        chunks = []
+        size = self.chunk_size
+        if size and len(result) > size:
+            includes = []
+            # packed or prefixed chunk may be a bit longer than its body
+            for N, part in enumerate(split_html(body, size-CHUNK_OVERHEAD)):
+                chunk_url = self._chunk_url(url, fresh[3], N)
+                chunks.append(('set', self.body_prefix+chunk_url, self._encode_body(endpoint, part), ttl))
+                includes.append('<!--# include virtual="{0}" -->'.format(chunk_url))
+            result = Compressor.unless_prefix+''.join(includes).encode('utf-8')
+            self._count_chunked(endpoint, len(chunks))
+        return chunks, [('set', self.body_prefix+url, result, ttl),
+                        ('set', self.fresh_prefix+url, fresh, ttl),
+                        ('delete', self.lock_prefix+url)]
+
+    def _chunk_url(self, url, token, number):
+        script_root = flask.request.script_root if flask.has_request_context() else ''
+        return '{0}/_inc/_chunk/{1}/{2}{3}'.format(script_root, token, number, url[len(script_root):])
+
+    def _serve_chunk(self, token, number, url):
+        """Serves chunk of large fragment URL requested by nginx because
+        chunk was evicted from memcached, the fragment is stored again.
+        Empty chunk is returned if the fragment is not the same anymore."""
+        fragment_view, kwargs = self._match_url('/'+url)
+        if fragment_view is None or not (self.memcache and fragment_view.cache_timeout):
+            flask.abort(404)
+        self._count_chunk_miss(fragment_view.cache_endpoint)
+        deferred_view = partial(fragment_view, **kwargs)
+        url = flask.request.script_root+'/'+url
+        body = self._cache_prepare(url, fragment_view.cache_timeout, deferred_view)
+        if body is None:
+            body = self._splice(self._call_view(deferred_view))
+        body = body.encode('utf-8')
+        chunk = b''
+        if self._etag(body) == token:
+            chunks = split_html(body, self.chunk_size-CHUNK_OVERHEAD)
+            if number < len(chunks):
+                chunk = chunks[number]
+        return flask.current_app.response_class(chunk, mimetype='text/html')
+
+    def _match_url(self, path):
+        """Returns fragment view and its arguments for `path` of fragment
+        URL without script root, view is None if it is not fragment URL."""
+        app = flask.current_app
+        if flask.has_request_context():
+            adapter = app.url_map.bind_to_environ(flask.request.environ)
+        else:
+            adapter = app.url_map.bind('')
+        try:
+            endpoint, kwargs = adapter.match(path, method='GET')
+        except HTTPException:
+            return None, None
+        return getattr(app.view_functions.get(endpoint), 'fragment_view', None), kwargs
+
+    def _fresh_value(self, timeout, generations, seconds, body):
+        """Returns value of fresh key of `body` rendered for `seconds`."""
+        now = int(time.time())
+        return (now+timeout, generations, round(seconds, 4), self._etag(body), now)
+
+    def _encode_body(self, endpoint, body):
+        compressor = self.compressor
+        if flask.current_app.config.get('FRAGMENT_COMPRESS_BODIES') and len(body) >= compressor.min_size:
+            # nginx cannot read packed body, it is for SSIMiddleware only
+            return compressor.pack(body, endpoint)
+        return Compressor.unless_prefix+body
 
     def _create_nginx_config(self, file_name, backend_host=None, backend_port=None,
                              frontend_host=None, frontend_port=None, memcached_host=None,
                              memcached_port=None, body_prefix=None):
-        """Creates nginx config file"""
+        """Creates nginx config file
+        
+        Memcached servers are `FRAGMENT_MEMCACHED_SERVERS` unless
+        `memcached_host` or `memcached_port` is given, nginx finds the key
+        on the same server as `KetamaRing` does.
+        """
         import os.path
         frontend = flask.current_app.config.get('SERVER_NAME')
         frontend = (frontend or 'localhost') + ':80'
         frontend_host = frontend_host or frontend.split(':')[0]
         frontend_port = frontend_port or int(frontend.split(':')[1])
+        if memcached_host or memcached_port:
+            servers = ['{0}:{1}'.format(memcached_host or '127.0.0.1', memcached_port or 11211)]
+        else:
+            servers = memcached_servers(flask.current_app.config)
         source_name = os.path.join(os.path.dirname(__file__), 'preserve', 'nginx.conf')
         with open(source_name) as source:
             conf = source.read() % dict(
                 frontend_host = frontend_host, frontend_port = frontend_port,
                 backend_host = backend_host or '127.0.0.1',
                 backend_port = backend_port or 5000,
-                memcached_host = memcached_host or '127.0.0.1',
-                memcached_port = memcached_port or 11211,
+                memcached_servers = '\n'.join('    server {0};'.format(server) for server in servers),
                 body_prefix = body_prefix or self.body_prefix)
             with open(file_name, 'w') as file:
                 file.write(conf)
\ No newline at end of file
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.aio
+    ----------------------
+
+    asyncio memcached client and concurrent preparation of fragments.
+
+    It requires Python 3.5+ and Flask 2.0+ for `async def` views.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+import flask
+import struct
+import pickle
+import asyncio
+import inspect
+import weakref
+import threading
+import contextvars
+from flask_fragment import FRESH, STALE, WORKER_ENVIRON_KEY
+from flask_fragment.stats import timer
+from flask_fragment.utilites import (subrequest_environ, memcached_servers, Compressor, KetamaRing,
+                                     HEADER, SETQ, DELETEQ, INCRQ, NOOP, STATUS_NOT_FOUND, logger)
+
+GET, SET, ADD, DELETE, INCR, GETKQ = 0x00, 0x01, 0x02, 0x04, 0x05, 0x0d
+
+# value flags, the same as `bmemcached` uses, so both clients read each other
+FLAG_OBJECT, FLAG_INTEGER, FLAG_LONG, FLAG_COMPRESSED, FLAG_BINARY = 1, 2, 4, 8, 16
+COMPRESSION_THRESHOLD = 128
+
+# config of SASL authentication, which the asyncio client does not speak
+SASL_CONFIG = ('FRAGMENT_MEMCACHED_USERNAME', 'FRAGMENT_MEMCACHED_PASSWORD',
+               'CACHE_MEMCACHED_USERNAME', 'CACHE_MEMCACHED_PASSWORD')
+
+
+def serialize(value, compressor):
+    """Returns `(flags, bytes)` of `value`."""
+    flags = 0
+    if isinstance(value, bytes):
+        flags |= FLAG_BINARY
+    elif isinstance(value, str):
+        value = value.encode('utf-8')
+    elif isinstance(value, int) and not isinstance(value, bool):
+        flags |= FLAG_INTEGER
+        value = str(value).encode()
+    else:
+        flags |= FLAG_OBJECT
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(value) > COMPRESSION_THRESHOLD:
+        compressed = compressor.compress(value)
+        if compressed and len(compressed) < len(value):
+            flags |= FLAG_COMPRESSED
+            value = compressed
+    return flags, value
+
+
+def deserialize(value, flags, compressor):
+    """Returns value stored with `flags`."""
+    if flags & FLAG_COMPRESSED:
+        value = compressor.decompress(value)
+    if flags & FLAG_BINARY:
+        return value
+    if flags & (FLAG_INTEGER | FLAG_LONG):
+        return int(value)
+    if flags & FLAG_OBJECT:
+        return pickle.loads(value)
+    return value.decode('utf-8')
+
+
+class AsyncMemcache(object):
+    """asyncio memcached client speaking the binary protocol
+
+    Like `bmemcached.Client` it writes to all servers and reads from the
+    first one that has the key, unless `ring` is given, then every key is
+    kept by one server. Idle connections are kept per event loop, so the
+    client can be shared by loops of different threads. If `loop` is given
+    connections are kept by its loop only and commands awaited on other
+    loops are run there, so loops which live for one request (Flask runs
+    every `async def` view on a new one) reuse them. SASL is not supported.
+    Like `bmemcached.Client` it takes a server that cannot be reached for
+    a miss on reads and failure on writes.
+
+    Args:
+        servers: List of `host:port` addresses.
+        compressor: Compressor of values, `Compressor` by default.
+        size: Max number of idle connections per server and loop.
+        ring: Object that maps key to server, see `KetamaRing`.
+        loop: `LoopThread` that keeps connections.
+    """
+    def __init__(self, servers, compressor=None, size=10, ring=None, loop=None):
+        self.servers = []
+        self._addresses = {}
+        for server in servers:
+            host, _, port = server.rpartition(':')
+            self._addresses[server] = (host, int(port))
+            self.servers.append(self._addresses[server])
+        self.compressor = compressor or Compressor()
+        self.size = size
+        self.ring = ring
+        self.loop = loop
+        self._idle = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_config(cls, config, loop=None):
+        """Creates client configured like `BMemcache` does."""
+        check_config(config)
+        servers = memcached_servers(config)
+        ring = None
+        if config.get('FRAGMENT_MEMCACHED_DISTRIBUTION') == 'consistent' and len(servers) > 1:
+            ring = KetamaRing(servers)
+        return cls(servers, Compressor.from_config(config),
+                   config.get('FRAGMENT_MEMCACHED_POOL_SIZE', 10), ring, loop)
+
+    def _servers(self, key):
+        if self.ring is None:
+            return self.servers
+        return [self._addresses[self.ring.get_server(key)]]
+
+    def _split(self, items, key=lambda item: item):
+        """Returns items grouped by server, all of them go to all servers
+        without ring."""
+        if self.ring is None:
+            return [(self.servers, list(items))]
+        groups = {}
+        for item in items:
+            groups.setdefault(self.ring.get_server(key(item)), []).append(item)
+        return [([self._addresses[server]], group) for server, group in groups.items()]
+
+    async def get(self, key):
+        for server in self._servers(key):
+            responses = await self._exchange(server, self._packet(GET, key))
+            if responses is None:
+                continue
+            response = responses[0]
+            if response[1] == 0:
+                return deserialize(response[5], struct.unpack('!I', response[3])[0], self.compressor)
+        return None
+
+    async def get_multi(self, keys):
+        result = {}
+        for values in await asyncio.gather(*[self._get_multi(servers, group)
+                                             for servers, group in self._split(keys)]):
+            result.update(values)
+        return result
+
+    async def _get_multi(self, servers, keys):
+        result = {}
+        for server in servers:
+            if not keys:
+                break
+            data = b''.join(self._packet(GETKQ, key, opaque=N) for N, key in enumerate(keys))
+            for response in await self._exchange(server, data + self._packet(NOOP), until_noop=True) or ():
+                key = keys[response[2]]
+                result[key] = deserialize(response[5], struct.unpack('!I', response[3])[0], self.compressor)
+            keys = [key for key in keys if key not in result]
+        return result
+
+    async def set(self, key, value, time=0):
+        return await self._store(SET, key, value, time)
+
+    async def add(self, key, value, time=0):
+        return await self._store(ADD, key, value, time)
+
+    async def delete(self, key):
+        responses = await self._all(key, self._packet(DELETE, key))
+        return all(response is not None and response[1] == 0 for response in responses)
+
+    async def incr(self, key, value):
+        # expiration 0xFFFFFFFF means that missing counter is not created
+        extras = struct.pack('!QQI', value, 0, 0xFFFFFFFF)
+        responses = await self._all(key, self._packet(INCR, key, extras))
+        if responses[0] is None or responses[0][1] != 0:
+            return None
+        return struct.unpack('!Q', responses[0][5])[0]
+
+    async def pipeline(self, ops):
+        """Sends commands as quiet requests terminated by `noop`, see
+        `MemcachePool.pipeline`, returns keys that failed."""
+        failed = []
+        for keys in await asyncio.gather(*[self._pipeline(servers, group) for servers, group
+                                           in self._split(ops, key=lambda op: op[1])]):
+            failed.extend(keys)
+        return failed
+
+    async def _pipeline(self, servers, ops):
+        chunks = []
+        for N, op in enumerate(ops):
+            command, key = op[0], op[1]
+            if command == 'set':
+                flags, value = serialize(op[2], self.compressor)
+                chunks.append(self._packet(SETQ, key, struct.pack('!II', flags, op[3]), value, N))
+            elif command == 'delete':
+                chunks.append(self._packet(DELETEQ, key, opaque=N))
+            elif command == 'incr':
+                chunks.append(self._packet(INCRQ, key, struct.pack('!QQI', op[2], 0, 0xFFFFFFFF), opaque=N))
+            else:
+                raise ValueError('Command "{0}" cannot be pipelined'.format(command))
+        chunks.append(self._packet(NOOP, opaque=len(ops)))
+        data = b''.join(chunks)
+        failed = []
+        for server in servers:
+            responses = await self._exchange(server, data, until_noop=True)
+            if responses is None:
+                failed.extend(op[1] for op in ops)
+                continue
+            for response in responses:
+                if response[1] != STATUS_NOT_FOUND:
+                    failed.append(ops[response[2]][1])
+        return failed
+
+    async def _store(self, opcode, key, value, time):
+        flags, value = serialize(value, self.compressor)
+        responses = await self._all(key, self._packet(opcode, key, struct.pack('!II', flags, time), value))
+        return all(response is not None and response[1] == 0 for response in responses)
+
+    async def _all(self, key, data):
+        """Sends `data` to all servers of `key`, returns their responses,
+        None for servers that cannot be reached."""
+        responses = await asyncio.gather(*[self._exchange(server, data) for server in self._servers(key)])
+        return [response[0] if response is not None else None for response in responses]
+
+    def _packet(self, opcode, key=b'', extras=b'', value=b'', opaque=0):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return HEADER.pack(0x80, opcode, len(key), len(extras), 0, 0,
+                           len(extras)+len(key)+len(value), opaque, 0) + extras + key + value
+
+    async def _exchange(self, server, data, until_noop=False):
+        """Sends `data`, returns responses as `(opcode, status, opaque,
+        extras, key, value)`, one or all of them up to `noop`, or None
+        if the server cannot be reached."""
+        if self.loop is not None and not self.loop.running():
+            return await asyncio.wrap_future(self.loop.submit(self._exchange(server, data, until_noop)))
+        try:
+            reader, writer = await self._acquire(server)
+        except OSError as exc:
+            logger.warning('Cannot connect to memcached %s:%s: %s', server[0], server[1], exc)
+            return None
+        responses = []
+        try:
+            writer.write(data)
+            while True:
+                header = HEADER.unpack(await reader.readexactly(HEADER.size))
+                opcode, keylen, extlen, status, bodylen, opaque = (
+                    header[1], header[2], header[3], header[5], header[6], header[7])
+                body = await reader.readexactly(bodylen)
+                if until_noop and opcode == NOOP:
+                    break
+                responses.append((opcode, status, opaque, body[:extlen],
+                                  body[extlen:extlen+keylen], body[extlen+keylen:]))
+                if not until_noop:
+                    break
+        except (OSError, asyncio.IncompleteReadError) as exc:
+            # broken connection is not returned to idle ones
+            writer.close()
+            logger.warning('Connection to memcached %s:%s failed: %r', server[0], server[1], exc)
+            return None
+        except BaseException:
+            writer.close()
+            raise
+        self._release(server, reader, writer)
+        return responses
+
+    async def _acquire(self, server):
+        idle = self._idle.get(asyncio.get_event_loop(), {}).get(server)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_connection(*server)
+
+    def _release(self, server, reader, writer):
+        idle = self._idle.setdefault(asyncio.get_event_loop(), {}).setdefault(server, [])
+        if len(idle) < self.size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+
+class AsyncStore(object):
+    """Awaitable wrapper of in-process memcache object like
+    `flask_fragment.shm.SharedMemoryStore`, its calls never block long."""
+    def __init__(self, memcache):
+        self.memcache = memcache
+
+    async def get(self, key):
+        return self.memcache.get(key)
+
+    async def get_multi(self, keys):
+        return self.memcache.get_multi(keys)
+
+    async def set(self, key, value, time=0):
+        return self.memcache.set(key, value, time)
+
+    async def add(self, key, value, time=0):
+        return self.memcache.add(key, value, time)
+
+    async def delete(self, key):
+        return self.memcache.delete(key)
+
+    async def incr(self, key, value):
+        return self.memcache.incr(key, value)
+
+    async def pipeline(self, ops):
+        return self.memcache.pipeline(ops)
+
+
+class LoopThread(object):
+    """Event loop running in a daemon thread, lets synchronous code await
+    coroutines. It is restarted after the process has been forked."""
+    def __init__(self):
+        self._pid = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def run(self, coro):
+        """Runs `coro` in the loop, waits and returns its result."""
+        return self.submit(coro).result()
+
+    def submit(self, coro):
+        """Schedules `coro` in the loop, returns `concurrent.futures.Future`."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def running(self):
+        """Returns True if it is called by coroutine of the loop."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return loop is self._loop and self._pid == os.getpid()
+
+    def _start(self):
+        self._loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        self._pid = os.getpid()
+
+
+def check_config(config):
+    """Raises ValueError if memcached of async mode needs SASL authentication,
+    otherwise the asyncio client would take every lookup for a miss."""
+    if config.get('FRAGMENT_STORAGE') != 'shm' and any(config.get(name) for name in SASL_CONFIG):
+        raise ValueError('Async mode does not support SASL authentication of memcached, '
+                         'unset FRAGMENT_ASYNC or FRAGMENT_MEMCACHED_USERNAME and PASSWORD')
+
+
+async def flush(fragment, app, memcache, environ, pending):
+    """Checks fragments collected by the request of `environ` and prepares
+    stale ones concurrently, one multi-get and one gather per nesting level.
+
+    Every fragment is prepared within its own request context.
+    """
+    while pending:
+        calls = dict()
+        for url, timeout, deferred_view in pending:
+            calls.setdefault(url, (timeout, deferred_view))
+        pending = []
+        keys = set()
+        tags = dict()
+        for url, (timeout, deferred_view) in calls.items():
+            tags[url] = fragment._view_tags(deferred_view)
+            keys.add(fragment.fresh_prefix+url)
+            keys.update(fragment.tag_prefix+tag for tag in tags[url])
+        values = await memcache.get_multi(list(keys))
+
+        async def update(url, timeout, deferred_view):
+            generations = tuple(values.get(fragment.tag_prefix+tag) for tag in tags[url])
+            sub_environ = subrequest_environ(environ, url)
+            sub_environ[WORKER_ENVIRON_KEY] = True
+            with app.request_context(sub_environ) as ctx:
+                state = fragment._fresh_state(values.get(fragment.fresh_prefix+url), generations)
+                fragment._count_state(url, deferred_view.func.cache_endpoint, state)
+                if state == FRESH or (state == STALE and fragment._refresh(url, timeout, deferred_view)):
+                    return
+                body = await prepare(fragment, memcache, url, timeout, deferred_view)
+                if body is None and state != STALE:
+                    await lock_lost(fragment, memcache, url, tags[url])
+                pending.extend(getattr(ctx, '_fragment_pending', None) or ())
+
+        await asyncio.gather(*[update(url, timeout, deferred_view)
+                               for url, (timeout, deferred_view) in calls.items()])
+
+
+async def prepare(fragment, memcache, url, timeout, deferred_view):
+    """Coroutine version of `Fragment._cache_prepare`."""
+    lock_timeout = fragment.lock_timeout
+    acquired = await memcache.add(fragment.lock_prefix+url, 1, lock_timeout)
+    endpoint = deferred_view.func.cache_endpoint
+    fragment._count_lock(url, endpoint, acquired)
+    if not acquired:
+        return None
+    timeout = fragment._adapt_timeout(endpoint, timeout)
+    generations = await tag_generations(fragment, memcache, fragment._view_tags(deferred_view),
+                                        url, endpoint)
+    started = timer()
+    if inspect.iscoroutinefunction(deferred_view.func):
+        body = await deferred_view()
+        fragment._count_render(endpoint, timer()-started)
+    else:
+        # sync view is called by executor thread within copy of request context
+        loop = asyncio.get_event_loop()
+        body = await loop.run_in_executor(None, contextvars.copy_context().run,
+                                          fragment._call_view, deferred_view)
+    encoded = body.encode('utf-8')
+    fresh = fragment._fresh_value(timeout, generations, timer()-started, encoded)
+    chunks, ops = fragment._store_ops(url, endpoint, encoded, fresh, timeout)
+    if chunks:
+        await memcache.pipeline(chunks)
+    await memcache.pipeline(ops)
+    fragment._count_store(url, endpoint, sum(len(op[2]) for op in chunks+ops[:1]))
+    return body
+
+
+async def tag_generations(fragment, memcache, tags, url=None, endpoint=None):
+    """Coroutine version of `Fragment._tag_generations`."""
+    if not tags:
+        return ()
+    keys = [fragment.tag_prefix+tag for tag in tags]
+    fresh_key = fragment.fresh_prefix+url if url is not None and fragment.adaptive_ttl is not None else None
+    values = await memcache.get_multi(keys+[fresh_key] if fresh_key else keys)
+    for key in keys:
+        if values.get(key) is None:
+            await memcache.add(key, int(time.time()*1000), 0)
+            values[key] = await memcache.get(key)
+    generations = tuple(values.get(key) for key in keys)
+    if fresh_key:
+        fragment._count_invalidated(endpoint, values.get(fresh_key), generations)
+    return generations
+
+
+async def lock_lost(fragment, memcache, url, tags):
+    """Waits for fragment rendered by other request if `FRAGMENT_LOCK_POLICY`
+    is `'wait'` or `'inline'`, includes are already emitted in async mode."""
+    config = flask.current_app.config
+    if config.get('FRAGMENT_LOCK_POLICY', 'stale') not in ('wait', 'inline'):
+        return
+    poll = config.get('FRAGMENT_LOCK_POLL', 0.05)
+    deadline = time.time()+config.get('FRAGMENT_LOCK_WAIT', 2)
+    while time.time() < deadline:
+        await asyncio.sleep(poll)
+        keys = [fragment.fresh_prefix+url] + [fragment.tag_prefix+tag for tag in tags]
+        values = await memcache.get_multi(keys)
+        generations = tuple(values.get(fragment.tag_prefix+tag) for tag in tags)
+        if fragment._fresh_state(values.get(fragment.fresh_prefix+url), generations) == FRESH:
+            return
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.l1
+    ---------------------
+
+    Per-process cache of fresh keys, tag generations and small bodies in
+    front of memcached.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import threading
+import collections
+from flask import _request_ctx_stack as request_stack
+from flask_fragment.utilites import pipeline
+
+# Estimated size of entry besides its bytes
+ENTRY_OVERHEAD = 200
+
+
+class L1Memcache(object):
+    """Memcache object that keeps values it reads and stores in process
+    memory for a few seconds
+
+    Values are dropped when this process deletes or increments their keys
+    (resets), and such commands also increment the shared epoch key. Every
+    request reads the epoch once and drops all values if it has changed, so
+    resets made by other workers are seen by the next request. Values read
+    outside of request (e.g. by `SSIMiddleware`) rely on `ttl` only, as do
+    bodies stored by other workers. Fresh keys are not kept after they get
+    stale, so a worker does not render a fragment another one has stored.
+
+    Args:
+        memcache: Memcache object.
+        size: Max size of kept values in bytes, approximately.
+        ttl: Seconds a value is kept.
+        max_item: Larger values are not kept.
+        epoch_key: Key of shared invalidation epoch.
+        exclude: Prefixes of keys that are not kept (render locks).
+        fresh_prefix: Prefix of fresh keys, their values start with the time
+            they get stale.
+    """
+    def __init__(self, memcache, size, ttl=2, max_item=4096, epoch_key='fragment:epoch', exclude=(),
+                 fresh_prefix='fragment:fresh:'):
+        self.memcache = memcache
+        self.size = size
+        self.ttl = ttl
+        self.max_item = max_item
+        self.epoch_key = epoch_key
+        self.exclude = tuple(exclude) + (epoch_key,)
+        self.fresh_prefix = fresh_prefix
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._epoch = None
+        self._lock = threading.Lock()
+        self._counters = dict((name, 0) for name in ('hits', 'misses', 'evictions', 'epoch_changes'))
+
+    def __getattr__(self, name):
+        # commands not cached, e.g. `flush_all`, and attributes like `max_value_size`
+        return getattr(self.memcache, name)
+
+    def _kept(self, key):
+        return not key.startswith(self.exclude)
+
+    def _check_epoch(self):
+        """Drops all values if epoch has changed, once per request."""
+        ctx = request_stack.top
+        if ctx is None or getattr(ctx, '_fragment_epoch_checked', False):
+            return
+        ctx._fragment_epoch_checked = True
+        epoch = self.memcache.get(self.epoch_key)
+        if epoch is None:
+            self.memcache.add(self.epoch_key, int(time.time()*1000), 0)
+            epoch = self.memcache.get(self.epoch_key)
+        with self._lock:
+            if epoch != self._epoch:
+                if self._epoch is not None:
+                    self._counters['epoch_changes'] += 1
+                self._epoch = epoch
+                self._items.clear()
+                self._bytes = 0
+
+    def _lookup(self, key, now):
+        item = self._items.pop(key, None)
+        if item is None or item[0] < now:
+            if item is not None:
+                self._bytes -= item[2]
+            self._counters['misses'] += 1
+            return None
+        self._items[key] = item
+        self._counters['hits'] += 1
+        return item[1]
+
+    def _keep(self, key, value):
+        length = len(value) if isinstance(value, bytes) else 0
+        size = ENTRY_OVERHEAD + length
+        expires = time.time()+self.ttl
+        if isinstance(value, tuple) and key.startswith(self.fresh_prefix):
+            expires = min(expires, value[0])
+        with self._lock:
+            self._drop(key)
+            if value is None or length > self.max_item or expires <= time.time():
+                return
+            self._items[key] = (expires, value, size)
+            self._bytes += size
+            while self._bytes > self.size and self._items:
+                key, item = self._items.popitem(last=False)
+                self._bytes -= item[2]
+                self._counters['evictions'] += 1
+
+    def _drop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def get(self, key):
+        if not self._kept(key):
+            return self.memcache.get(key)
+        self._check_epoch()
+        with self._lock:
+            value = self._lookup(key, time.time())
+        if value is None:
+            value = self.memcache.get(key)
+            self._keep(key, value)
+        return value
+
+    def get_multi(self, keys):
+        self._check_epoch()
+        result = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._lookup(key, now) if self._kept(key) else None
+                if value is None:
+                    missing.append(key)
+                else:
+                    result[key] = value
+        if missing:
+            values = self.memcache.get_multi(missing)
+            for key in missing:
+                if key in values and self._kept(key):
+                    self._keep(key, values[key])
+            result.update(values)
+        return result
+
+    def set(self, key, value, time=0):
+        result = self.memcache.set(key, value, time)
+        if self._kept(key):
+            self._keep(key, value)
+        return result
+
+    def set_multi(self, mappings, time=0):
+        result = self.memcache.set_multi(mappings, time)
+        for key, value in mappings.items():
+            if self._kept(key):
+                self._keep(key, value)
+        return result
+
+    def add(self, key, value, time=0):
+        self._forget([key])
+        return self.memcache.add(key, value, time)
+
+    def delete(self, key):
+        result = self.memcache.delete(key)
+        self._invalidate([key])
+        return result
+
+    def delete_multi(self, keys):
+        result = self.memcache.delete_multi(keys)
+        self._invalidate(keys)
+        return result
+
+    def incr(self, key, value):
+        result = self.memcache.incr(key, value)
+        self._invalidate([key])
+        return result
+
+    def decr(self, key, value):
+        result = self.memcache.decr(key, value)
+        self._invalidate([key])
+        return result
+
+    def pipeline(self, ops):
+        invalidated = [op[1] for op in ops if op[0] != 'set' and self._kept(op[1])]
+        if invalidated:
+            # epoch is incremented after the keys are changed
+            ops = list(ops) + [('incr', self.epoch_key, 1)]
+        result = pipeline(self.memcache, ops)
+        for op in ops:
+            if op[0] == 'set' and self._kept(op[1]):
+                self._keep(op[1], op[2])
+        self._forget(invalidated)
+        return result
+
+    def flush_all(self, *args, **kwargs):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+        return self.memcache.flush_all(*args, **kwargs)
+
+    def _forget(self, keys):
+        """Drops values of `keys`, returns True if any of them may be kept."""
+        kept = [key for key in keys if self._kept(key)]
+        with self._lock:
+            for key in kept:
+                self._drop(key)
+        return bool(kept)
+
+    def _invalidate(self, keys):
+        # other workers drop their values by new epoch, a missing epoch is
+        # not created by `incr`, then they see a new one
+        if self._forget(keys):
+            pipeline(self.memcache, [('incr', self.epoch_key, 1)])
+
+    def snapshot(self):
+        """Returns hit, miss, eviction and epoch change counters, number of
+        values and their size in bytes."""
+        with self._lock:
+            result = dict(self._counters)
+            result['items'] = len(self._items)
+            result['bytes'] = self._bytes
+            return result
+
+    def prometheus(self):
+        """Returns counters in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name in ('hits', 'misses', 'evictions', 'epoch_changes'):
+            lines.append('# TYPE fragment_l1_{0}_total counter'.format(name))
+            lines.append('fragment_l1_{0}_total {1}'.format(name, snapshot[name]))
+        for name in ('items', 'bytes'):
+            lines.append('# TYPE fragment_l1_{0} gauge'.format(name))
+            lines.append('fragment_l1_{0} {1}'.format(name, snapshot[name]))
+        return '\n'.join(lines) + '\n'
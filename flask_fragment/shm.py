@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.shm
+    ----------------------
+
+    Memcache interface on top of shared memory for single host deployments.
+
+    Fragment bodies, fresh keys, locks and tag counters are kept in a file
+    mapped into memory by every worker process of the host (`/dev/shm` by
+    default), so `fragment()` costs no network round trip. nginx cannot read
+    it, pages have to be assembled by `flask_fragment.ssi.SSIMiddleware`.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import pickle
+import struct
+import numbers
+import tempfile
+import threading
+
+# file header: magic, version, ways per bucket, number of lock stripes,
+# number of slot classes and (slot size, number of buckets) of every class
+MAGIC, VERSION = b'FRAGSHM\0', 2
+HEADER = struct.Struct('<8sIIII')
+CLASS = struct.Struct('<II')
+HEADER_SIZE = 4096
+MAX_CLASSES = 64
+
+# bucket head: clock hand, bitmask of referenced slots and tag of every
+# slot (hash byte of its key, 0 if slot is free), then slots follow
+HEAD = struct.Struct('<BB')
+BUCKET_HEAD = 16
+MAX_WAYS = 8
+TAGS = [struct.pack('<B', N or 1) for N in range(256)]
+FREE = b'\0'
+
+# slot: key length, value length, flags, expiration, then key and value
+SLOT = struct.Struct('<HIId')
+
+# value flags
+FLAG_BYTES, FLAG_TEXT, FLAG_INTEGER, FLAG_OBJECT = 0, 1, 2, 3
+
+# memcached treats expiration longer than 30 days as unix time
+RELATIVE_EXPIRATION_MAX = 60*60*24*30
+
+# `time` arguments of memcache interface shadow the module
+_now = time.time
+
+
+def ShmMemcache(app, config):
+    """Returns shared memory store configured by `FRAGMENT_SHM_*` values
+
+    Args:
+        app: Flask application instance.
+        config: Flask application config.
+
+    Returns:
+        Object that implemented memcache interface
+        or None if fragment caching disabled.
+    """
+    if config.get('FRAGMENT_CACHING'):
+        path = config.get('FRAGMENT_SHM_PATH')
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(directory, 'flask_fragment.{0}'.format(app.import_name))
+        return SharedMemoryStore(path, size=config.get('FRAGMENT_SHM_SIZE', 64*1024*1024),
+                                 slot_sizes=config.get('FRAGMENT_SHM_SLOT_SIZES',
+                                                       (256, 1024, 4096, 16384, 65536)))
+    return None
+
+
+class SharedMemoryStore(object):
+    """Memory mapped hash table that implements memcache interface
+
+    Memory is split equally between classes of fixed size slots, a value
+    is stored in the smallest slot it fits, larger values are not stored,
+    like ones over the memcached item size limit. Key hash selects a bucket
+    of `ways` slots in every class, a new item takes a free or expired slot
+    of its bucket, otherwise the bucket clock evicts an item that was not
+    read since the clock passed it last time.
+
+    Processes are synchronized by `fcntl` locks on stripes of buckets,
+    threads of a process by thread locks, so `add` can be used as a lock.
+    Number of buckets of every class is a multiple of `locks`, so a bucket
+    is guarded by the same stripe whichever key selects it. The file
+    is created once with the given geometry; a file of other geometry is
+    replaced, processes which still map the old one use it until restart.
+
+    Args:
+        path: Path of the mapped file, it should be on tmpfs.
+        size: Size of memory for items in bytes.
+        slot_sizes: Sizes of slots of every class.
+        ways: Number of slots in a bucket.
+        locks: Max number of lock stripes, fewer if the smallest class
+            has fewer buckets.
+    """
+    def __init__(self, path, size=64*1024*1024, slot_sizes=(256, 1024, 4096, 16384, 65536),
+                 ways=8, locks=64):
+        slot_sizes = sorted(slot_sizes)
+        if not 0 < len(slot_sizes) <= MAX_CLASSES or slot_sizes[0] <= SLOT.size:
+            raise ValueError('Slot sizes must be 1-{0} sizes over {1} bytes'.format(
+                MAX_CLASSES, SLOT.size))
+        if not 0 < ways <= MAX_WAYS:
+            raise ValueError('Number of ways must be 1-{0}'.format(MAX_WAYS))
+        if locks < 1:
+            raise ValueError('Number of lock stripes must be positive')
+        fits = [(size-HEADER_SIZE)//len(slot_sizes)//(BUCKET_HEAD+ways*slot_size)
+                for slot_size in slot_sizes]
+        if min(fits) < 1:
+            raise ValueError('Size must hold a bucket of every slot class')
+        self.path = path
+        self.ways = ways
+        self.locks = min(locks, min(fits))
+        self.classes = []
+        offset = HEADER_SIZE
+        for slot_size, buckets in zip(slot_sizes, fits):
+            bucket_size = BUCKET_HEAD+ways*slot_size
+            # bucket `hash % buckets` belongs to stripe `hash % locks`
+            buckets = buckets//self.locks*self.locks
+            self.classes.append((slot_size-SLOT.size, offset, bucket_size, buckets))
+            offset += buckets*bucket_size
+        self.size = offset
+        # larger values are split by `Fragment` (keys are up to 250 bytes)
+        self.max_value_size = self.classes[-1][0]-250
+        self._open()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._thread_locks = [threading.Lock() for N in range(self.locks)]
+
+    def _open(self):
+        header = HEADER.pack(MAGIC, VERSION, self.ways, self.locks, len(self.classes)) + b''.join(
+            CLASS.pack(capacity+SLOT.size, buckets) for capacity, offset, size, buckets in self.classes)
+        guard = os.open(self.path+'.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(guard, fcntl.LOCK_EX)
+            try:
+                fd = os.open(self.path, os.O_RDWR)
+            except OSError:
+                fd = None
+            if fd is not None and (os.fstat(fd).st_size != self.size
+                                   or os.read(fd, len(header)) != header):
+                os.close(fd)
+                fd = None
+            if fd is None:
+                # new file is filled with zeros, that is all slots are empty
+                temp = '{0}.{1}'.format(self.path, os.getpid())
+                fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.ftruncate(fd, self.size)
+                os.write(fd, header)
+                os.rename(temp, self.path)
+            self._fd = fd
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            fcntl.lockf(guard, fcntl.LOCK_UN)
+            os.close(guard)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _acquire(self, stripe):
+        if self._pid != os.getpid():
+            # thread locks might be held by threads of the parent process
+            self._reset()
+        self._thread_locks[stripe].acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+        except Exception:
+            self._thread_locks[stripe].release()
+            raise
+
+    def _release(self, stripe):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        self._thread_locks[stripe].release()
+
+    def _key(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return key, zlib.crc32(key) & 0xFFFFFFFF
+
+    def _stripe(self, hash):
+        """Returns lock stripe of buckets of `hash` in every class."""
+        return hash % self.classes[0][3] % self.locks
+
+    def _find(self, key, hash, now):
+        """Returns `(bucket, way, slot, header)` of live item of `key` or None."""
+        mm = self._map
+        tag = TAGS[hash >> 24]
+        for capacity, offset, bucket_size, buckets in self.classes:
+            bucket = offset+(hash % buckets)*bucket_size
+            tags = mm[bucket+HEAD.size:bucket+HEAD.size+self.ways]
+            way = tags.find(tag)
+            while way >= 0:
+                slot = bucket+BUCKET_HEAD+way*(capacity+SLOT.size)
+                item = SLOT.unpack_from(mm, slot)
+                if item[0] == len(key) and mm[slot+SLOT.size:slot+SLOT.size+item[0]] == key:
+                    if item[3] and item[3] <= now:
+                        self._free(bucket, way)
+                        return None
+                    return bucket, way, slot, item
+                way = tags.find(tag, way+1)
+        return None
+
+    def _free(self, bucket, way):
+        self._map[bucket+HEAD.size+way:bucket+HEAD.size+way+1] = FREE
+
+    def _referenced(self, bucket, way):
+        hand, referenced = HEAD.unpack_from(self._map, bucket)
+        if not referenced & (1 << way):
+            HEAD.pack_into(self._map, bucket, hand, referenced | (1 << way))
+
+    def _read(self, slot, item):
+        start = slot+SLOT.size+item[0]
+        return decode(self._map[start:start+item[1]], item[2])
+
+    def _store(self, key, hash, flags, data, time, now, found=None):
+        """Writes item to slot of the smallest class it fits."""
+        mm = self._map
+        if time and time <= RELATIVE_EXPIRATION_MAX:
+            time = now+time
+        needed = len(key)+len(data)
+        for capacity, offset, bucket_size, buckets in self.classes:
+            if needed <= capacity:
+                break
+        else:
+            if found is not None:
+                self._free(found[0], found[1])
+            return False
+        bucket = offset+(hash % buckets)*bucket_size
+        if found is not None and found[0] != bucket:
+            self._free(found[0], found[1])
+            found = None
+        way = found[1] if found is not None else self._victim(bucket, capacity, now)
+        slot = bucket+BUCKET_HEAD+way*(capacity+SLOT.size)
+        # new item is not referenced, it gets second chance only if it is read
+        hand, referenced = HEAD.unpack_from(mm, bucket)
+        HEAD.pack_into(mm, bucket, hand, referenced & ~(1 << way))
+        SLOT.pack_into(mm, slot, len(key), len(data), flags, time)
+        mm[slot+SLOT.size:slot+SLOT.size+needed] = key+data
+        mm[bucket+HEAD.size+way:bucket+HEAD.size+way+1] = TAGS[hash >> 24]
+        return True
+
+    def _victim(self, bucket, capacity, now):
+        """Returns free or expired way of bucket, otherwise evicts one."""
+        mm = self._map
+        tags = mm[bucket+HEAD.size:bucket+HEAD.size+self.ways]
+        way = tags.find(FREE)
+        if way >= 0:
+            return way
+        for way in range(self.ways):
+            expires = SLOT.unpack_from(mm, bucket+BUCKET_HEAD+way*(capacity+SLOT.size))[3]
+            if expires and expires <= now:
+                return way
+        hand, referenced = HEAD.unpack_from(mm, bucket)
+        hand %= self.ways
+        # second chance: referenced slots passed by the hand are cleared
+        while referenced & (1 << hand):
+            referenced &= ~(1 << hand)
+            hand = (hand+1) % self.ways
+        HEAD.pack_into(mm, bucket, (hand+1) % self.ways, referenced)
+        return hand
+
+    def get(self, key):
+        key, hash = self._key(key)
+        stripe = self._stripe(hash)
+        self._acquire(stripe)
+        try:
+            found = self._find(key, hash, _now())
+            if found is None:
+                return None
+            bucket, way, slot, item = found
+            self._referenced(bucket, way)
+            return self._read(slot, item)
+        finally:
+            self._release(stripe)
+
+    def get_multi(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, time=0):
+        flags, data = encode(value)
+        key, hash = self._key(key)
+        stripe = self._stripe(hash)
+        self._acquire(stripe)
+        try:
+            now = _now()
+            return self._store(key, hash, flags, data, time, now, self._find(key, hash, now))
+        finally:
+            self._release(stripe)
+
+    def set_multi(self, mappings, time=0):
+        return [key for key, value in mappings.items() if not self.set(key, value, time)]
+
+    def add(self, key, value, time=0):
+        flags, data = encode(value)
+        key, hash = self._key(key)
+        stripe = self._stripe(hash)
+        self._acquire(stripe)
+        try:
+            now = _now()
+            if self._find(key, hash, now) is not None:
+                return False
+            return self._store(key, hash, flags, data, time, now)
+        finally:
+            self._release(stripe)
+
+    def delete(self, key):
+        key, hash = self._key(key)
+        stripe = self._stripe(hash)
+        self._acquire(stripe)
+        try:
+            found = self._find(key, hash, _now())
+            if found is None:
+                return False
+            self._free(found[0], found[1])
+            return True
+        finally:
+            self._release(stripe)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
+
+    def incr(self, key, value):
+        """Increments integer value, returns new value or None if key is missing."""
+        key, hash = self._key(key)
+        stripe = self._stripe(hash)
+        self._acquire(stripe)
+        try:
+            now = _now()
+            found = self._find(key, hash, now)
+            if found is None:
+                return None
+            bucket, way, slot, item = found
+            if item[2] != FLAG_INTEGER:
+                raise ValueError('Cannot increment non integer value of "{0}"'.format(key))
+            value = max(self._read(slot, item)+value, 0)
+            self._store(key, hash, FLAG_INTEGER, str(value).encode('ascii'), item[3], now, found)
+            return value
+        finally:
+            self._release(stripe)
+
+    def decr(self, key, value):
+        return self.incr(key, -value)
+
+    def pipeline(self, ops):
+        """Executes commands like `MemcachePool.pipeline`, returns keys that failed."""
+        failed = []
+        for op in ops:
+            if op[0] not in ('set', 'delete', 'incr'):
+                raise ValueError('Command "{0}" cannot be pipelined'.format(op[0]))
+            if getattr(self, op[0])(*op[1:]) is False and op[0] == 'set':
+                failed.append(op[1])
+        return failed
+
+    def flush_all(self):
+        """Drops all items."""
+        for stripe in range(self.locks):
+            self._acquire(stripe)
+        try:
+            for capacity, offset, bucket_size, buckets in self.classes:
+                self._map[offset:offset+buckets*bucket_size] = b'\0'*(buckets*bucket_size)
+        finally:
+            for stripe in range(self.locks):
+                self._release(stripe)
+
+
+def encode(value):
+    """Returns `(flags, bytes)` of `value`."""
+    if isinstance(value, bytes):
+        return FLAG_BYTES, value
+    if isinstance(value, type(u'')):
+        return FLAG_TEXT, value.encode('utf-8')
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return FLAG_INTEGER, str(value).encode('ascii')
+    return FLAG_OBJECT, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data, flags):
+    """Returns value encoded with `flags`."""
+    if flags == FLAG_BYTES:
+        return data
+    if flags == FLAG_TEXT:
+        return data.decode('utf-8')
+    if flags == FLAG_INTEGER:
+        return int(data)
+    return pickle.loads(data)
+
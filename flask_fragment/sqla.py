@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.sqla
+    -----------------------
+
+    Resets fragments which depend on SQLAlchemy models when the transaction
+    that changed them commits.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import flask
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# prefix of tags that fragments get from `depends_on`
+TAG_PREFIX = 'sql:'
+
+
+class Invalidator(object):
+    """Collects tags of fragments that depend on objects changed by session
+    flushes and resets them at once after commit, nothing after rollback
+
+    A model dependency (`Post`) is a tag `sql:Post` reset by any change of
+    any post. A column dependency (`Comment.post_id`) is a tag with column
+    value, `sql:Comment.post_id=5`; fragment gets it with the value of view
+    argument of the same name (or given by `(Comment.post_id, 'post_id')`).
+    Old and new values of changed column are both reset. Bulk query
+    updates and deletes bypass the session, they are not seen.
+
+    Args:
+        fragment: `Fragment` extension instance.
+    """
+    def __init__(self, fragment):
+        self.fragment = fragment
+        # model: set of column keys, None stands for any change of model
+        self.watched = {}
+        event.listen(Session, 'after_flush', self.after_flush)
+        event.listen(Session, 'after_commit', self.after_commit)
+        event.listen(Session, 'after_transaction_end', self.after_transaction_end)
+
+    def watch(self, depends_on, args_names):
+        """Returns tag templates of fragment view with `depends_on`, they
+        are formatted with view arguments."""
+        tags = []
+        for dependency in depends_on:
+            arg_name = None
+            if isinstance(dependency, tuple):
+                dependency, arg_name = dependency
+            if isinstance(dependency, type):
+                self.watched.setdefault(dependency, set()).add(None)
+                tags.append(model_tag(dependency))
+                continue
+            model, key = dependency.class_, dependency.key
+            arg_name = arg_name or key
+            if arg_name not in args_names:
+                raise ValueError('View has no argument "{0}" for {1}.{2}'.format(
+                    arg_name, model.__name__, key))
+            self.watched.setdefault(model, set()).add(key)
+            tags.append(column_tag(model, key, '{' + arg_name + '}'))
+        return tags
+
+    def after_flush(self, session, flush_context):
+        # collections and attribute history still have pre-flush state
+        tags = set()
+        dirty = session.dirty
+        for obj in list(session.new) + list(dirty) + list(session.deleted):
+            if obj in dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            state = inspect(obj)
+            for mapper in state.mapper.iterate_to_root():
+                for key in self.watched.get(mapper.class_, ()):
+                    if key is None:
+                        tags.add(model_tag(mapper.class_))
+                        continue
+                    values = state.attrs[key].history.sum() or [state.dict.get(key)]
+                    tags.update(column_tag(mapper.class_, key, value) for value in values)
+        if tags:
+            session.info.setdefault(self, set()).update(tags)
+
+    def after_commit(self, session):
+        tags = session.info.pop(self, None)
+        if not tags:
+            return
+        if flask.has_app_context():
+            self.fragment.reset_tag(*sorted(tags))
+        elif self.fragment.app is not None:
+            with self.fragment.app.app_context():
+                self.fragment.reset_tag(*sorted(tags))
+
+    def after_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            # transaction was rolled back, its changes are discarded
+            session.info.pop(self, None)
+
+
+def model_tag(model):
+    return '{0}{1}'.format(TAG_PREFIX, model.__name__)
+
+
+def column_tag(model, key, value):
+    return '{0}{1}.{2}={3}'.format(TAG_PREFIX, model.__name__, key, value)
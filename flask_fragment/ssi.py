@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.ssi
+    ----------------------
+
+    WSGI middleware that assembles SSI includes in-process.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import re
+from flask_fragment.utilites import subrequest_environ
+
+INCLUDE_RE = re.compile(br'<!--#\s*include\s+virtual="([^"]*)"\s*-->')
+DIRECTIVE_START = b'<!--#'
+
+
+class SSIMiddleware(object):
+    """Resolves `<!--# include virtual="..." -->` directives like nginx does
+
+    Bodies of included fragments are read from the same memcached keys
+    nginx uses, all includes of one response chunk (and then of each
+    nesting level) are fetched with one multi-get. On miss the fragment
+    view is called in-process. Stitched output is streamed chunk by chunk.
+    Bodies packed because of `FRAGMENT_COMPRESS_BODIES` are unpacked.
+
+    Usage::
+
+        app.wsgi_app = SSIMiddleware(app, fragment)
+
+    Args:
+        app: Flask application instance.
+        fragment: `Fragment` extension instance.
+        max_depth: Max nesting level of includes.
+    """
+    def __init__(self, app, fragment, max_depth=10):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.fragment = fragment
+        self.max_depth = max_depth
+
+    def __call__(self, environ, start_response):
+        captured = {}
+        def capture_start_response(status, headers, exc_info=None):
+            content_type = dict((name.lower(), value) for name, value in headers).get('content-type', '')
+            if content_type.startswith('text/html'):
+                captured['html'] = True
+                headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+            return start_response(status, headers, exc_info)
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        if not captured.get('html') or environ.get('REQUEST_METHOD') == 'HEAD':
+            return app_iter
+        return self._stream(environ, app_iter)
+
+    def _stream(self, environ, app_iter):
+        with self.app.app_context():
+            memcache = self.fragment.memcache
+            compressor = self.fragment.compressor
+        tail = b''
+        try:
+            for chunk in app_iter:
+                data = tail + chunk
+                cut = self._safe_cut(data)
+                data, tail = data[:cut], data[cut:]
+                if data:
+                    yield self._assemble(environ, memcache, compressor, data)
+            if tail:
+                yield self._assemble(environ, memcache, compressor, tail)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _safe_cut(self, data):
+        """Returns position before unfinished directive at the end of `data`."""
+        start = data.rfind(DIRECTIVE_START)
+        if start != -1 and data.find(b'-->', start) == -1:
+            return start
+        for size in range(len(DIRECTIVE_START)-1, 0, -1):
+            if data.endswith(DIRECTIVE_START[:size]):
+                return len(data)-size
+        return len(data)
+
+    def _assemble(self, environ, memcache, compressor, data):
+        """Resolves includes of `data`, one multi-get per nesting level."""
+        root = self._split(data)
+        level = [part for part in root if isinstance(part, list)]
+        depth = 0
+        while level:
+            depth += 1
+            keys = set(self.fragment.body_prefix+part[0] for part in level)
+            bodies = memcache.get_multi(list(keys)) if memcache else {}
+            next_level = []
+            for part in level:
+                url = part[0]
+                if depth > self.max_depth:
+                    body = b''
+                else:
+                    body = bodies.get(self.fragment.body_prefix+url)
+                    if body is None:
+                        body = bodies[self.fragment.body_prefix+url] = self._subrequest(environ, url)
+                    body = compressor.unpack(body)
+                part[:] = self._split(body)
+                next_level.extend(item for item in part if isinstance(item, list))
+            level = next_level
+        return b''.join(self._flatten(root))
+
+    def _split(self, data):
+        """Splits `data` to list of text and includes, include is
+        a list that holds URL and then is replaced by its content."""
+        parts = []
+        position = 0
+        for match in INCLUDE_RE.finditer(data):
+            parts.append(data[position:match.start()])
+            parts.append([match.group(1).decode('utf-8')])
+            position = match.end()
+        parts.append(data[position:])
+        return parts
+
+    def _flatten(self, parts):
+        for part in parts:
+            if isinstance(part, list):
+                for item in self._flatten(part):
+                    yield item
+            else:
+                yield part
+
+    def _subrequest(self, environ, url):
+        """Calls fragment view in-process, like nginx falls back to `@process`."""
+        status = []
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return lambda data: None
+        app_iter = self.wsgi_app(subrequest_environ(environ, url), start_response)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        return body if status and status[0].startswith('200') else b''
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.stats
+    ------------------------
+
+    Signals and per-endpoint cache metrics.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import flask
+import threading
+from flask.signals import Namespace
+
+timer = getattr(time, 'perf_counter', time.time)
+
+_signals = Namespace()
+
+#: Sent when fragment is fresh, arguments: `endpoint`, `url`.
+fragment_hit = _signals.signal('fragment-hit')
+#: Sent when fragment is stale or missing, arguments: `endpoint`, `url`, `state`.
+fragment_miss = _signals.signal('fragment-miss')
+#: Sent after render lock is taken, arguments: `endpoint`, `url`, `acquired`.
+fragment_lock = _signals.signal('fragment-lock')
+#: Sent after fragment view is called, arguments: `endpoint`, `seconds`.
+fragment_rendered = _signals.signal('fragment-rendered')
+#: Sent after fragment body is stored, arguments: `endpoint`, `url`, `size`.
+fragment_stored = _signals.signal('fragment-stored')
+#: Sent on reset, arguments: `endpoint` and `url` or `tag`.
+fragment_reset = _signals.signal('fragment-reset')
+#: Sent after traced request, argument: `trace` (see `flask_fragment.trace`).
+fragment_traced = _signals.signal('fragment-traced')
+
+
+def send(signal, **kwargs):
+    """Sends `signal` only if it has receivers, it is cheaper."""
+    if getattr(signal, 'receivers', None):
+        signal.send(flask.current_app._get_current_object(), **kwargs)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class Stats(object):
+    """Per-endpoint counters and render time histograms of the process
+
+    All updates take one short lock, so stats may be left on in production.
+    """
+    COUNTERS = ('hits', 'misses', 'stale', 'lock_acquired', 'lock_lost',
+                'stores', 'body_bytes', 'resets', 'not_modified', 'chunked', 'chunks',
+                'chunk_misses', 'memo_hits')
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._tags = {}
+
+    def _endpoint(self, endpoint):
+        data = self._endpoints.get(endpoint)
+        if data is None:
+            data = self._endpoints[endpoint] = dict((name, 0) for name in self.COUNTERS)
+            data['render_buckets'] = [0] * (len(self.BUCKETS)+1)
+            data['render_sum'] = 0.0
+        return data
+
+    def incr(self, endpoint, counter, value=1):
+        with self._lock:
+            self._endpoint(endpoint)[counter] += value
+
+    def observe(self, endpoint, seconds):
+        """Adds render time to histogram."""
+        index = len(self.BUCKETS)
+        for N, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                index = N
+                break
+        with self._lock:
+            data = self._endpoint(endpoint)
+            data['render_buckets'][index] += 1
+            data['render_sum'] += seconds
+
+    def tag_reset(self, tag):
+        with self._lock:
+            self._tags[tag] = self._tags.get(tag, 0) + 1
+
+    def snapshot(self):
+        """Returns copy of all metrics as dict."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, data in self._endpoints.items():
+                endpoints[endpoint] = dict(data)
+                endpoints[endpoint]['render_buckets'] = list(data['render_buckets'])
+                endpoints[endpoint]['renders'] = sum(data['render_buckets'])
+            return {'endpoints': endpoints, 'tag_resets': dict(self._tags)}
+
+    def prometheus(self):
+        """Returns metrics in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        endpoints = sorted(snapshot['endpoints'].items())
+        lines = []
+        for name in self.COUNTERS:
+            metric = 'fragment_{0}_total'.format(name)
+            lines.append('# TYPE {0} counter'.format(metric))
+            for endpoint, data in endpoints:
+                lines.append('{0}{{endpoint="{1}"}} {2}'.format(metric, _label(endpoint), data[name]))
+        lines.append('# TYPE fragment_render_seconds histogram')
+        for endpoint, data in endpoints:
+            endpoint = _label(endpoint)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), data['render_buckets']):
+                cumulative += count
+                lines.append('fragment_render_seconds_bucket{{endpoint="{0}",le="{1}"}} {2}'.format(
+                    endpoint, bound, cumulative))
+            lines.append('fragment_render_seconds_sum{{endpoint="{0}"}} {1}'.format(
+                endpoint, data['render_sum']))
+            lines.append('fragment_render_seconds_count{{endpoint="{0}"}} {1}'.format(
+                endpoint, cumulative))
+        lines.append('# TYPE fragment_tag_resets_total counter')
+        for tag, count in sorted(snapshot['tag_resets'].items()):
+            lines.append('fragment_tag_resets_total{{tag="{0}"}} {1}'.format(_label(tag), count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.trace
+    ------------------------
+
+    Per-request trace of fragment calls: a tree of spans with cache
+    decisions, memcached commands and render times of fragment views.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+from flask_fragment.stats import timer
+
+# Number of functions kept from profile of a render
+PROFILE_LINES = 25
+
+# cProfile cannot run several profilers at once (Python 3.12+ refuses),
+# so only one render of the process is profiled at a time
+_profile_lock = threading.Lock()
+
+
+class _NoSpan(object):
+    """Stands for span when request is not traced."""
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    __slots__ = ('id', 'parent', 'name', 'thread', 'start', 'end', 'attrs')
+
+    def __init__(self, id, parent, name, attrs):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.thread = threading.current_thread().ident
+        self.attrs = attrs
+        self.start = timer()
+        self.end = None
+
+
+class Trace(object):
+    """Spans of one request: fragment calls, cache decisions, memcached
+    commands and renders of fragment views, nested as they were called
+
+    Fragments rendered by worker threads (parallel and refresh modes) are
+    added under the span that submitted them. Spans are appended under
+    a short lock, so worker threads may share the trace.
+
+    Args:
+        url: URL of traced request.
+        profile: Whether renders of stale and missing fragments are run
+            under `cProfile`, top functions are kept in the span.
+    """
+    def __init__(self, url, profile=False):
+        self.url = url
+        self.profile = profile
+        self.started = time.time()
+        self.duration = None
+        self.spans = []
+        self._origin = timer()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._proxies = {}
+
+    def current(self):
+        """Returns innermost open span of the thread or None."""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def attach(self, parent):
+        """Makes `parent` span (of other thread) the parent of spans of this thread."""
+        self._local.stack = [parent] if parent is not None else []
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1].id if stack else None
+        with self._lock:
+            span = Span(len(self.spans), parent, name, attrs)
+            self.spans.append(span)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = timer()
+            stack.pop()
+
+    def annotate(self, **attrs):
+        """Adds `attrs` to innermost open span of the thread."""
+        span = self.current()
+        if span is not None:
+            span.attrs.update(attrs)
+
+    def profiled(self, func, *args):
+        """Calls `func` under `cProfile` if `profile` is set, keeps top
+        functions by cumulative time in the current span."""
+        if not self.profile or not _profile_lock.acquire(False):
+            return func(*args)
+        import cProfile
+        import pstats
+        try:
+            from cStringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            _profile_lock.release()
+            output = StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            self.annotate(profile=output.getvalue())
+
+    def wrap(self, memcache):
+        """Returns proxy of `memcache` that records its commands as spans."""
+        proxy = self._proxies.get(id(memcache))
+        if proxy is None:
+            proxy = self._proxies[id(memcache)] = TracedMemcache(memcache, self)
+        return proxy
+
+    def finish(self):
+        self.duration = timer()-self._origin
+
+    def to_dict(self):
+        """Returns trace as JSON serializable tree of spans."""
+        nodes = []
+        for span in self.spans:
+            end = span.end if span.end is not None else timer()
+            nodes.append({'name': span.name,
+                          'start_ms': round((span.start-self._origin)*1000, 3),
+                          'duration_ms': round((end-span.start)*1000, 3),
+                          'thread': span.thread,
+                          'attrs': _plain(span.attrs),
+                          'children': []})
+        roots = []
+        for span, node in zip(self.spans, nodes):
+            (nodes[span.parent]['children'] if span.parent is not None else roots).append(node)
+        return {'url': self.url, 'started': self.started,
+                'duration_ms': round((self.duration or 0)*1000, 3), 'spans': roots}
+
+    def chrome_events(self):
+        """Returns spans as complete events of Chrome trace event format,
+        load `{"traceEvents": events}` into chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        start = self.started*10**6
+        events = []
+        for span in self.spans:
+            end = span.end if span.end is not None else timer()
+            args = _plain(span.attrs)
+            args.setdefault('request', self.url)
+            events.append({'name': span.name, 'cat': 'fragment', 'ph': 'X',
+                           'ts': round(start+(span.start-self._origin)*10**6, 1),
+                           'dur': round((end-span.start)*10**6, 1),
+                           'pid': pid, 'tid': span.thread, 'args': args})
+        return events
+
+
+class TracedMemcache(object):
+    """Proxy of memcache object that records every command as a span."""
+    def __init__(self, memcache, trace):
+        self._memcache = memcache
+        self._trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self._memcache, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        trace = self._trace
+        def command(*args, **kwargs):
+            with trace.span('memcache.'+name, **_command_attrs(name, args)):
+                return attr(*args, **kwargs)
+        return command
+
+
+def _command_attrs(name, args):
+    if not args:
+        return {}
+    if name == 'get_multi':
+        return {'keys': len(args[0])}
+    if name == 'pipeline':
+        return {'ops': len(args[0])}
+    return {'key': args[0]}
+
+
+def _plain(value):
+    """Returns copy of attributes of span where values which JSON cannot
+    keep (e.g. view arguments) are replaced by their `repr`."""
+    if isinstance(value, dict):
+        return dict((str(key), _plain(item)) for key, item in value.items())
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
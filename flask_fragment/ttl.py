@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.ttl
+    ----------------------
+
+    Adaptive per-endpoint timeouts of cached fragments.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import math
+import threading
+from flask_fragment.stats import _label
+
+# Weight of the last render in render time average
+RENDER_ALPHA = 0.1
+
+# Counters are halved after that many stores, so old traffic fades out
+WINDOW = 500
+
+# Stores of endpoint observed before its timeout is tuned
+MIN_STORES = 10
+
+# Number of timeouts tried between the bounds
+CANDIDATES = 25
+
+
+class AdaptiveTTL(object):
+    """Chooses timeouts of fragments from render time, hit ratio and
+    resets of their endpoints observed by the process
+
+    A stored fragment lives until it expires or is reset. Resets are taken
+    as random events of rate `lambda`, estimated from the share of stores
+    reset before expiry, so the expected life with timeout `T` is
+    `L(T) = (1 - exp(-lambda*T)) / lambda`. Between lives the fragment waits
+    for the next request, `g`, estimated from hit ratio. The chosen timeout
+    minimizes render seconds per second plus the price of staleness::
+
+        s / (L(T) + g) + s_ref * T / T0**2
+
+    where `s` is average render time of endpoint, `s_ref` is the median of
+    averages of all cached endpoints and `T0` is the `cache` timeout of the
+    view. For a typical endpoint that is never reset `T0` is the best,
+    expensive ones get longer timeouts (`T0 * sqrt(s / s_ref)`), frequently
+    reset, rarely read and cheap ones get shorter. It stays within `bounds`
+    (factors of `T0`).
+
+    Args:
+        bounds: Min and max factor of `cache` timeout.
+    """
+    def __init__(self, bounds=(0.25, 4.0)):
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _endpoint(self, endpoint):
+        data = self._endpoints.get(endpoint)
+        if data is None:
+            data = self._endpoints[endpoint] = {
+                'render_seconds': None, 'reads': 0, 'hits': 0, 'stores': 0,
+                'resets': 0, 'ttl': None, 'base': None}
+        return data
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(tuple(config.get('FRAGMENT_ADAPTIVE_TTL_BOUNDS', (0.25, 4.0))))
+
+    def observe_render(self, endpoint, seconds):
+        with self._lock:
+            data = self._endpoint(endpoint)
+            average = data['render_seconds']
+            data['render_seconds'] = seconds if average is None else \
+                average + RENDER_ALPHA*(seconds-average)
+
+    def observe_read(self, endpoint, hit):
+        with self._lock:
+            data = self._endpoint(endpoint)
+            data['reads'] += 1
+            data['hits'] += int(hit)
+
+    def observe_store(self, endpoint):
+        with self._lock:
+            data = self._endpoint(endpoint)
+            data['stores'] += 1
+            if data['stores'] > WINDOW:
+                for name in ('reads', 'hits', 'stores', 'resets'):
+                    data[name] /= 2.0
+
+    def observe_reset(self, endpoint):
+        """Counts fragment of endpoint reset before expiry."""
+        with self._lock:
+            self._endpoint(endpoint)['resets'] += 1
+
+    def ttl(self, endpoint, base):
+        """Returns timeout of fragment of `endpoint` whose view has `cache`
+        timeout `base`, `base` until enough stores are observed."""
+        with self._lock:
+            data = self._endpoint(endpoint)
+            data['base'] = base
+            # views which are not cached are not taken into account
+            averages = [item['render_seconds'] for item in self._endpoints.values()
+                        if item['render_seconds'] is not None and item['base'] is not None]
+            if data['stores'] < MIN_STORES or data['render_seconds'] is None or not sum(averages):
+                data['ttl'] = base
+                return base
+            averages.sort()
+            data['ttl'] = self._best(data, base, averages[len(averages)//2])
+            return data['ttl']
+
+    def _best(self, data, base, reference):
+        current = data['ttl'] or base
+        share = min(data['resets']/float(data['stores']), 0.95)
+        rate = -math.log(1.0-share)/current
+        def life(ttl):
+            if rate*ttl < 1e-9:
+                return ttl
+            return (1.0-math.exp(-rate*ttl))/rate
+        hit_ratio = data['hits']/float(data['reads']) if data['reads'] else 1.0
+        if hit_ratio <= 0:
+            return int(math.ceil(base*self.bounds[0]))
+        wait = (1.0-hit_ratio)/hit_ratio*life(current)
+        low, high = base*self.bounds[0], base*self.bounds[1]
+        step = (high/low)**(1.0/(CANDIDATES-1)) if high > low else 1.0
+        seconds = data['render_seconds']
+        best, best_cost = base, None
+        for N in range(CANDIDATES):
+            ttl = low*step**N
+            cost = seconds/(life(ttl)+wait) + reference*ttl/base**2
+            if best_cost is None or cost < best_cost:
+                best, best_cost = ttl, cost
+        return max(int(round(best)), 1)
+
+    def current(self, endpoint, base):
+        """Returns timeout last chosen by `ttl` for `endpoint`, `base` if none."""
+        with self._lock:
+            data = self._endpoints.get(endpoint)
+            return data['ttl'] if data is not None and data['ttl'] is not None else base
+
+    def snapshot(self):
+        """Returns chosen timeouts and the figures they are based on by endpoint."""
+        with self._lock:
+            result = {}
+            for endpoint, data in self._endpoints.items():
+                if data['ttl'] is None:
+                    continue
+                result[endpoint] = {
+                    'ttl': data['ttl'], 'base': data['base'],
+                    'render_seconds': data['render_seconds'],
+                    'hit_ratio': data['hits']/float(data['reads']) if data['reads'] else None,
+                    'reset_ratio': data['resets']/float(data['stores']) if data['stores'] else None,
+                    'stores': data['stores']}
+            return result
+
+    def prometheus(self):
+        """Returns chosen timeouts in Prometheus text exposition format."""
+        lines = ['# TYPE fragment_ttl_seconds gauge']
+        for endpoint, data in sorted(self.snapshot().items()):
+            lines.append('fragment_ttl_seconds{{endpoint="{0}"}} {1}'.format(_label(endpoint), data['ttl']))
+        return '\n'.join(lines) + '\n'
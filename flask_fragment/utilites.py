@@ -8,8 +8,34 @@
     :copyright: (c) 2013 by Alexey Poryadin.
     :license: MIT, see LICENSE for more details.
 """
+import os
+import re
+import time
 import zlib
-import bmemcached
+import bisect
+import struct
+import socket
+import logging
+import threading
+import collections
+from io import BytesIO
+from functools import partial
+from contextlib import contextmanager
+
+logger = logging.getLogger('flask_fragment')
+
+# binary protocol header and opcodes of quiet commands used by pipeline
+HEADER = struct.Struct('!BBHBBHIIQ')
+SETQ, DELETEQ, INCRQ, NOOP = 0x11, 0x14, 0x15, 0x0a
+STATUS_NOT_FOUND, STATUS_DISCONNECTED = 0x01, 0xFFFFFFFF
+
+# pieces of HTML counted by Compressor.train
+TRAIN_PIECE_RE = re.compile(br'<[^<>]{1,256}>|[^<>]{4,256}')
+
+# elements whose text shows comments put between chunks by `split_html`
+RAW_TEXT_ELEMENTS = (b'script', b'style', b'textarea', b'title')
+SPLIT_TRIES = 64
+
 
 def BMemcache(app, config, *args, **kwargs):
     """Returns memcache object recommended for the extension
@@ -24,37 +50,650 @@ def BMemcache(app, config, *args, **kwargs):
     """
     if config.get('FRAGMENT_CACHING'):
         import bmemcached
-        return bmemcached.Client(**{
-            'servers':  config.get('FRAGMENT_MEMCACHED_SERVERS',
-                        config.get('CACHE_MEMCACHED_SERVERS', ('127.0.0.1:11211',))),
-            'username': config.get('FRAGMENT_MEMCACHED_USERNAME',
-                        config.get('CACHE_MEMCACHED_PASSWORD')),
-            'password': config.get('FRAGMENT_MEMCACHED_PASSWORD',
-                        config.get('CACHE_MEMCACHED_PASSWORD')),
-            'compression': Compressor()
-        })
+        def pool(servers):
+            return MemcachePool(partial(bmemcached.Client, **{
+                'servers':  servers,
+                'username': config.get('FRAGMENT_MEMCACHED_USERNAME',
+                            config.get('CACHE_MEMCACHED_PASSWORD')),
+                'password': config.get('FRAGMENT_MEMCACHED_PASSWORD',
+                            config.get('CACHE_MEMCACHED_PASSWORD')),
+                'compression': Compressor.from_config(config)
+            }), size=config.get('FRAGMENT_MEMCACHED_POOL_SIZE', 10),
+                keepalive=config.get('FRAGMENT_MEMCACHED_KEEPALIVE', True),
+                max_idle=config.get('FRAGMENT_MEMCACHED_MAX_IDLE', 300),
+                retries=config.get('FRAGMENT_MEMCACHED_RETRIES', 1))
+        servers = memcached_servers(config)
+        if config.get('FRAGMENT_MEMCACHED_DISTRIBUTION') == 'consistent' and len(servers) > 1:
+            return ShardedMemcache(KetamaRing(servers),
+                                   dict((server, pool([server])) for server in servers))
+        return pool(servers)
     return None
 
 
+def memcached_servers(config):
+    """Returns list of `host:port` of memcached servers from config."""
+    return list(config.get('FRAGMENT_MEMCACHED_SERVERS',
+                           config.get('CACHE_MEMCACHED_SERVERS', ('127.0.0.1:11211',))))
+
+
+class KetamaRing(object):
+    """Consistent hashing ring that maps keys to servers exactly like
+    nginx `hash $key consistent` does for the same upstream servers
+    
+    Every server gets 160 points per weight, the first point is crc32 of
+    `host\\0port` followed by 4 zero bytes, the next ones are followed by
+    the previous point (little-endian). A key goes to the first point not
+    less than crc32 of the key, wrapping around the ring.
+    
+    Args:
+        servers: List of servers as they are written in upstream block,
+            `host:port` or `unix:/path`.
+        weights: Dict of server weights, 1 by default.
+    """
+    POINTS = 160
+
+    def __init__(self, servers, weights=None):
+        points = []
+        for server in servers:
+            base = zlib.crc32(self._host_port(server))
+            point = 0
+            for N in range(self.POINTS*(weights or {}).get(server, 1)):
+                point = zlib.crc32(struct.pack('<I', point), base) & 0xFFFFFFFF
+                points.append((point, server))
+        points.sort(key=lambda point: point[0])
+        self._hashes = [point for point, server in points]
+        self._servers = [server for point, server in points]
+
+    @staticmethod
+    def _host_port(server):
+        if server.startswith('unix:'):
+            host, port = server[5:], ''
+        else:
+            host, sep, port = server.rpartition(':')
+            if not sep or not port.isdigit():
+                host, port = server, ''
+        return (host + '\0' + port).encode('utf-8')
+
+    def get_server(self, key):
+        """Returns server of `key`."""
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        index = bisect.bisect_left(self._hashes, zlib.crc32(key) & 0xFFFFFFFF)
+        return self._servers[index % len(self._servers)]
+
+
+class ShardedMemcache(object):
+    """Memcache interface over several memcache objects, every key is kept
+    by one of them chosen by `ring`. Multi-key calls are split by server.
+    
+    Args:
+        ring: Object that maps key to server, see `KetamaRing`.
+        memcaches: Dict of memcache objects (`MemcachePool`) by server.
+    """
+    def __init__(self, ring, memcaches):
+        self.ring = ring
+        self.memcaches = memcaches
+
+    def _memcache(self, key):
+        return self.memcaches[self.ring.get_server(key)]
+
+    def _split(self, items, key=lambda item: item):
+        groups = collections.defaultdict(list)
+        for item in items:
+            groups[self.ring.get_server(key(item))].append(item)
+        return [(self.memcaches[server], group) for server, group in groups.items()]
+
+    def get(self, key):
+        return self._memcache(key).get(key)
+
+    def get_multi(self, keys):
+        values = {}
+        for memcache, group in self._split(keys):
+            values.update(memcache.get_multi(group))
+        return values
+
+    def set(self, key, value, time=0):
+        return self._memcache(key).set(key, value, time)
+
+    def set_multi(self, mappings, time=0):
+        failed = []
+        for memcache, group in self._split(mappings):
+            failed.extend(memcache.set_multi(dict((key, mappings[key]) for key in group), time) or ())
+        return failed
+
+    def add(self, key, value, time=0):
+        return self._memcache(key).add(key, value, time)
+
+    def delete(self, key):
+        return self._memcache(key).delete(key)
+
+    def delete_multi(self, keys):
+        return all([memcache.delete_multi(group) for memcache, group in self._split(keys)])
+
+    def incr(self, key, value):
+        return self._memcache(key).incr(key, value)
+
+    def decr(self, key, value):
+        return self._memcache(key).decr(key, value)
+
+    def pipeline(self, ops):
+        """Sends commands pipelined to every server, see `MemcachePool.pipeline`."""
+        failed = []
+        for memcache, group in self._split(ops, key=lambda op: op[1]):
+            failed.extend(pipeline(memcache, group) or ())
+        return failed
+
+
+class MemcachePool(object):
+    """Thread-safe and fork-safe pool of memcache clients
+    
+    Implements the same memcache interface as a single client, every call
+    borrows an idle client (connection) from pool and returns it back. Pool
+    is dropped and refilled lazily after the process has been forked.
+    
+    Args:
+        factory: Callable that creates new memcache client.
+        size: Max number of idle clients kept in pool.
+        keepalive: Enables TCP keepalive for the pooled connections.
+        max_idle: Seconds after which idle client is reconnected.
+        retries: How many times failed call is retried with new connection.
+    """
+    def __init__(self, factory, size=10, keepalive=True, max_idle=300, retries=1):
+        self.factory = factory
+        self.size = size
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.retries = retries
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def acquire(self):
+        """Borrows client from pool or creates new one."""
+        if self._pid != os.getpid():
+            # connections were inherited from the parent process
+            self._reset()
+        with self._lock:
+            while self._idle:
+                client, released_at = self._idle.pop()
+                if self.max_idle is None or time.time()-released_at < self.max_idle:
+                    return client
+                self._disconnect(client)
+        return self.factory()
+
+    def release(self, client):
+        """Returns client to pool."""
+        if self._pid != os.getpid():
+            return
+        if self.keepalive:
+            self._set_keepalive(client)
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((client, time.time()))
+                return
+        self._disconnect(client)
+
+    @contextmanager
+    def reserve(self):
+        """Context manager that borrows client for several calls."""
+        client = self.acquire()
+        try:
+            yield client
+        except Exception:
+            self._disconnect(client)
+            raise
+        else:
+            self.release(client)
+
+    def call(self, method, *args, **kwargs):
+        """Calls client `method`, reconnects and retries if it failed."""
+        attempt = 0
+        while True:
+            client = self.acquire()
+            try:
+                result = getattr(client, method)(*args, **kwargs)
+            except Exception:
+                self._disconnect(client)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+            else:
+                self.release(client)
+                return result
+
+    def get(self, key):
+        return self.call('get', key)
+
+    def get_multi(self, keys):
+        return self.call('get_multi', keys)
+
+    def set(self, key, value, time=0):
+        return self.call('set', key, value, time)
+
+    def set_multi(self, mappings, time=0):
+        return self.call('set_multi', mappings, time)
+
+    def add(self, key, value, time=0):
+        return self.call('add', key, value, time)
+
+    def delete(self, key):
+        return self.call('delete', key)
+
+    def delete_multi(self, keys):
+        return self.call('delete_multi', keys)
+
+    def incr(self, key, value):
+        return self.call('incr', key, value)
+
+    def decr(self, key, value):
+        return self.call('decr', key, value)
+
+    def pipeline(self, ops, batch_size=1000):
+        """Sends commands as quiet binary protocol requests
+        
+        Requests are terminated by `noop`, memcached answers only failed
+        ones, so every `batch_size` commands cost one round trip.
+        
+        Args:
+            ops: List of tuples like ('set', key, value, time),
+                ('delete', key) or ('incr', key, delta).
+            batch_size: Max number of commands sent at once.
+        
+        Returns:
+            List of keys that failed.
+        """
+        ops = list(ops)
+        failed = []
+        with self.reserve() as client:
+            servers = list(getattr(client, '_servers', ()))
+            if not servers or not all(hasattr(server, '_get_response') for server in servers):
+                # client does not speak binary protocol
+                for op in ops:
+                    if not getattr(client, op[0])(*op[1:]) and op[0] != 'delete':
+                        failed.append(op[1])
+                return failed
+            for server in servers:
+                for N in range(0, len(ops), batch_size):
+                    failed.extend(_send_quiet(server, ops[N:N+batch_size]))
+        return failed
+
+    def _set_keepalive(self, client):
+        for server in getattr(client, '_servers', ()):
+            conn = getattr(server, 'connection', None)
+            if conn is not None and getattr(server, '_fragment_keepalive', None) is not conn:
+                try:
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    server._fragment_keepalive = conn
+                except (socket.error, AttributeError):
+                    pass
+
+    def _disconnect(self, client):
+        try:
+            client.disconnect_all()
+        except Exception:
+            pass
+
+
+def pipeline(memcache, ops):
+    """Executes memcache commands as one pipelined batch if memcache object
+    supports it, otherwise one by one
+    
+    Args:
+        memcache: Object that implemented memcache interface.
+        ops: List of tuples like ('set', key, value, time),
+            ('delete', key) or ('incr', key, delta).
+    """
+    if hasattr(memcache, 'pipeline'):
+        return memcache.pipeline(ops)
+    for op in ops:
+        getattr(memcache, op[0])(*op[1:])
+
+
+def _send_quiet(server, ops):
+    """Sends `ops` to bmemcached protocol object `server` with quiet
+    opcodes and reads replies up to `noop`, returns keys that failed."""
+    chunks = []
+    for N, op in enumerate(ops):
+        command, key = op[0], op[1]
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        value = b''
+        if command == 'set':
+            flags, value = server.serialize(op[2])
+            extras, opcode = struct.pack('!II', flags, op[3]), SETQ
+        elif command == 'delete':
+            extras, opcode = b'', DELETEQ
+        elif command == 'incr':
+            # expiration 0xFFFFFFFF means that missing counter is not created
+            extras, opcode = struct.pack('!QQI', op[2], 0, 0xFFFFFFFF), INCRQ
+        else:
+            raise ValueError('Command "{0}" cannot be pipelined'.format(command))
+        chunks.append(HEADER.pack(0x80, opcode, len(key), len(extras), 0, 0,
+                                  len(extras)+len(key)+len(value), N, 0))
+        chunks.extend((extras, key, value))
+    chunks.append(HEADER.pack(0x80, NOOP, 0, 0, 0, 0, 0, len(ops), 0))
+    server._send(b''.join(chunks))
+    failed = []
+    while True:
+        response = server._get_response()
+        opcode, status, opaque = response[1], response[5], response[7]
+        if status == STATUS_DISCONNECTED:
+            return [op[1] for op in ops]
+        if opcode == NOOP:
+            return failed
+        if status != STATUS_NOT_FOUND:
+            failed.append(ops[opaque][1])
+
+
+def subrequest_environ(environ, url):
+    """Returns WSGI environ of GET request to `url`
+    
+    New environ carries the headers of `environ`, the same as nginx passes
+    to backend when it processes included fragment.
+    
+    Args:
+        environ: WSGI environ of parent request.
+        url: URL of subrequest including script root.
+    """
+    script_name = environ.get('SCRIPT_NAME', '')
+    if not url.startswith(script_name):
+        script_name = ''
+    environ = dict(environ)
+    environ.pop('werkzeug.request', None)
+    environ.pop('CONTENT_TYPE', None)
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': url[len(script_name):],
+        'QUERY_STRING': '',
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': BytesIO(),
+    })
+    return environ
+
+
+def split_html(data, size):
+    """Splits HTML `data` to chunks not longer than `size` bytes
+    
+    Chunks are cut before a tag which is not within a comment (or SSI
+    directive) or raw text element, so a comment can be put between them.
+    If there is no such tag, text is cut at UTF-8 character boundary.
+    """
+    lower = data.lower()
+    chunks = []
+    start = 0
+    while len(data)-start > size:
+        end = _split_point(data, lower, start, start+size)
+        chunks.append(data[start:end])
+        start = end
+    chunks.append(data[start:])
+    return chunks
+
+
+def _split_point(data, lower, start, end):
+    position = data.rfind(b'<', start+1, end)
+    for N in range(SPLIT_TRIES):
+        if position == -1:
+            break
+        if data[position+1:position+2].isalpha() or data[position+1:position+2] in (b'/', b'!'):
+            comment = data.rfind(b'<!--', 0, position)
+            if comment == -1 or data.find(b'-->', comment+4, position) != -1:
+                if not any(lower.rfind(b'<'+name, 0, position) > lower.rfind(b'</'+name, 0, position)
+                           for name in RAW_TEXT_ELEMENTS):
+                    return position
+        position = data.rfind(b'<', start+1, position)
+    while end > start+1 and 0x80 <= ord(data[end:end+1]) < 0xC0:
+        end -= 1
+    return end
+
+
+class Task(object):
+    """Task queued to `WorkerPool`, holds its result when done"""
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as exc:
+            self.error = exc
+            logger.exception('Background task "%s" failed', self.key)
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        self.error = RuntimeError('Task "{0}" has been dropped'.format(self.key))
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Waits until task is done, returns False on timeout."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class WorkerPool(object):
+    """Bounded pool of daemon threads that runs tasks in background
+    
+    Tasks are identified by key, a task is not queued again while the task
+    with the same key is queued or running, tasks with key None are never
+    merged. Threads are started lazily and restarted after the process has
+    been forked.
+    
+    Args:
+        workers: Max number of threads.
+        queue_size: Max number of queued tasks.
+        drop: Which task is dropped when queue is full, 'new' or 'old'.
+    """
+    def __init__(self, workers=2, queue_size=100, drop='new'):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.drop = drop
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._tasks = {}
+        self._threads = []
+
+    def submit(self, key, func, *args):
+        """Queues task, returns `Task` or None if task has been dropped."""
+        if self._pid != os.getpid():
+            self._reset()
+        with self._cond:
+            if key is not None and key in self._tasks:
+                return self._tasks[key]
+            if len(self._queue) >= self.queue_size:
+                if self.drop != 'old' or not self._queue:
+                    return None
+                dropped = self._queue.popleft()
+                self._tasks.pop(dropped.key, None)
+                dropped.cancel()
+            task = Task(key, func, args)
+            self._queue.append(task)
+            if key is not None:
+                self._tasks[key] = task
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                task = self._queue.popleft()
+            try:
+                task.run()
+            finally:
+                with self._cond:
+                    if self._tasks.get(task.key) is task:
+                        del self._tasks[task.key]
+
+
+# Marks missing item, None may be a value
+_missing = object()
+
+
+class LRUCache(object):
+    """Thread safe dict limited by number of items, least recently used
+    items are dropped first
+    
+    Args:
+        size: Max number of items.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._items.pop(key, _missing)
+            if value is _missing:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
 class Compressor(object):
     """Compressor class recommended for the extension
     
+    Values that start with `unless_prefix` are stored as is, so nginx can
+    read them. Values packed by `pack` start with `packed_prefix`, they are
+    read only by the extension itself (see `flask_fragment.ssi`).
+    
     Args:
         default_compressor: Object that implemented compress/decompress ability. Dezault zlib.
+        level: zlib compression level.
+        min_size: Values shorter than that are not compressed.
+        dictionaries: Dict of zlib preset dictionaries by name (endpoint),
+            they require Python 3.3+.
     """
     unless_prefix = b'<!--INC-->'
+    packed_prefix = b'<!--ZIP-->'
     
-    def __init__(self, default_compressor=None):
+    def __init__(self, default_compressor=None, level=-1, min_size=0, dictionaries=None):
         self.real = default_compressor or zlib
+        self.level = level
+        self.min_size = min_size
+        self.dictionaries = {}
+        self._dictionaries_by_id = {}
+        for name, zdict in (dictionaries or {}).items():
+            self.add_dictionary(name, zdict)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates compressor configured by `FRAGMENT_COMPRESS_*` values."""
+        dictionaries = {}
+        for name, zdict in config.get('FRAGMENT_COMPRESS_DICTIONARIES', {}).items():
+            if not isinstance(zdict, bytes):
+                # path to file with trained dictionary
+                with open(zdict, 'rb') as file:
+                    zdict = file.read()
+            dictionaries[name] = zdict
+        return cls(level=config.get('FRAGMENT_COMPRESS_LEVEL', -1),
+                   min_size=config.get('FRAGMENT_COMPRESS_MIN_SIZE', 256),
+                   dictionaries=dictionaries)
+
+    def add_dictionary(self, name, zdict):
+        self.dictionaries[name] = zdict
+        self._dictionaries_by_id[zlib.adler32(zdict) & 0xFFFFFFFF] = zdict
+
+    def _is_raw(self, value):
+        return (value[0:len(self.unless_prefix)]==self.unless_prefix
+                or value[0:len(self.packed_prefix)]==self.packed_prefix)
     
     def compress(self, value):
-        if value[0:len(self.unless_prefix)]==self.unless_prefix:
+        if self._is_raw(value) or len(value) < self.min_size:
             return value
+        elif self.real is zlib:
+            return zlib.compress(value, self.level)
         else:
             return self.real.compress(value)
 
     def decompress(self, value):
-        if value[0:len(self.unless_prefix)]==self.unless_prefix:
+        if self._is_raw(value):
             return value
+        elif self.real is zlib:
+            return self._inflate(value)
+        else:
+            return self.real.decompress(value)
+
+    def pack(self, value, name=None):
+        """Compresses `value` with preset dictionary `name` if it is set."""
+        zdict = self.dictionaries.get(name)
+        if zdict:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS,
+                                          zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
         else:
-            return self.real.decompress(value)
\ No newline at end of file
+            compressor = zlib.compressobj(self.level)
+        return self.packed_prefix + compressor.compress(value) + compressor.flush()
+
+    def unpack(self, value):
+        """Decompresses value packed by `pack`, other values are returned as is."""
+        if value[0:len(self.packed_prefix)]!=self.packed_prefix:
+            return value
+        return self._inflate(value[len(self.packed_prefix):])
+
+    def _inflate(self, value):
+        # zlib header keeps adler32 of preset dictionary if it was used
+        if len(value) > 6 and ord(value[1:2]) & 0x20:
+            dictid = struct.unpack('!I', value[2:6])[0]
+            zdict = self._dictionaries_by_id.get(dictid)
+            if zdict is None:
+                raise ValueError('Unknown zlib dictionary {0:#x}'.format(dictid))
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict)
+            return decompressor.decompress(value) + decompressor.flush()
+        return zlib.decompress(value)
+
+    @staticmethod
+    def train(samples, size=16384):
+        """Builds zlib preset dictionary from sample fragment bodies
+        
+        HTML is split to tags and texts, pieces met in more than one sample
+        are ranked by count multiplied by length. The best ones are put at
+        the end of dictionary, where they are the cheapest to reference.
+        
+        Args:
+            samples: Iterable of sample bodies (bytes).
+            size: Max size of dictionary.
+        """
+        counts = collections.Counter()
+        for sample in samples:
+            counts.update(set(TRAIN_PIECE_RE.findall(sample)))
+        ranked = sorted(((count*len(piece), piece) for piece, count in counts.items() if count > 1),
+                        reverse=True)
+        chosen, total = [], 0
+        for score, piece in ranked:
+            if total+len(piece) <= size:
+                chosen.append(piece)
+                total += len(piece)
+        return b''.join(reversed(chosen))
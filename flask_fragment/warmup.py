@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.fragment.warmup
+    -------------------------
+
+    Pre-renders cached fragments before the application takes traffic.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import sys
+import time
+import flask
+import multiprocessing
+from functools import partial
+from flask_fragment import FRESH
+
+# Statuses of warmed up fragment, fresh ones have status `FRESH`
+RENDERED, LOCKED, FAILED = 'rendered', 'locked', 'failed'
+
+# App and extension used by pool processes, they are inherited by fork
+_target = None
+
+
+def warmup(fragment, app, endpoints=None, processes=4, rate=None, force=False, progress=None):
+    """Renders and stores fragments which have `warmup_args`
+
+    Every fragment is rendered within its own request context. Fragments
+    which are fresh or are being rendered by other request are skipped.
+    Pool processes are forked whatever the default start method is, so it
+    works only where fork is available, use `processes=0` elsewhere.
+
+    Args:
+        fragment: `Fragment` extension instance.
+        app: Flask application instance.
+        endpoints: Endpoints to warm up, all if None.
+        processes: Number of processes, 0 renders in current process.
+        rate: Max number of fragments started per second.
+        force: Renders also fragments that are fresh.
+        progress: Function called with `done, total, url, status, error`.
+
+    Returns:
+        Dict with number of fragments by status and list of failures.
+    """
+    global _target
+    jobs = [job + (force,) for job in _jobs(app, endpoints)]
+    summary = {RENDERED: 0, FRESH: 0, LOCKED: 0, FAILED: 0, 'failures': []}
+    _target = (app, fragment)
+    pool = None
+    try:
+        if processes:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise ValueError('Warm-up processes need fork, use processes=0')
+            # `_target` is not passed to spawned processes
+            pool = multiprocessing.get_context('fork').Pool(processes)
+            results = pool.imap_unordered(_run_job, _throttle(jobs, rate))
+        else:
+            results = (_run_job(job) for job in _throttle(jobs, rate))
+        for done, (url, status, error) in enumerate(results, 1):
+            summary[status] += 1
+            if error is not None:
+                summary['failures'].append((url, error))
+            if progress is not None:
+                progress(done, len(jobs), url, status, error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _target = None
+    return summary
+
+
+def _jobs(app, endpoints):
+    """Yields `(endpoint, kwargs)` of fragments to warm up."""
+    for endpoint in sorted(endpoints or app.view_functions):
+        fragment_view = getattr(app.view_functions.get(endpoint), 'fragment_view', None)
+        if fragment_view is None:
+            if endpoints:
+                raise ValueError('Not found fragment view for endpoint "{0}"'.format(endpoint))
+            continue
+        if not fragment_view.cache_timeout or fragment_view.cache_warmup is None:
+            continue
+        for args in fragment_view.cache_warmup():
+            if isinstance(args, dict):
+                kwargs = dict(args)
+            else:
+                if not isinstance(args, (tuple, list)):
+                    args = (args,)
+                kwargs = dict(zip(fragment_view.args_names, args))
+            yield endpoint, kwargs
+
+
+def _throttle(jobs, rate):
+    """Yields `jobs` no faster than `rate` per second."""
+    interval = 1.0/rate if rate else 0
+    next_at = time.time()
+    for job in jobs:
+        delay = next_at-time.time()
+        if delay > 0:
+            time.sleep(delay)
+        next_at = max(next_at, time.time())+interval
+        yield job
+
+
+def _run_job(job):
+    app, fragment = _target
+    endpoint, kwargs, force = job
+    fragment_view = app.view_functions[endpoint].fragment_view
+    url = None
+    try:
+        with app.test_request_context():
+            url = flask.url_for(endpoint, **kwargs)
+        with app.test_request_context(url):
+            deferred_view = partial(fragment_view, **kwargs)
+            if not force and fragment._cache_state(url, fragment._view_tags(deferred_view)) == FRESH:
+                return url, FRESH, None
+            if fragment._cache_prepare(url, fragment_view.cache_timeout, deferred_view) is None:
+                return url, LOCKED, None
+            # nested fragments collected by batched mode
+            fragment.flush()
+            return url, RENDERED, None
+    except Exception as exc:
+        return url or endpoint, FAILED, '{0}: {1}'.format(type(exc).__name__, exc)
+
+
+def print_progress(done, total, url, status, error):
+    """Progress function that writes a line per fragment to stderr."""
+    line = '[{0}/{1}] {2} {3}'.format(done, total, status, url)
+    if error is not None:
+        line += ' ' + error
+    sys.stderr.write(line + '\n')
+
+
+def register_cli(app, fragment):
+    """Adds `fragment-warmup` command to `flask` CLI of `app`."""
+    import click
+
+    @app.cli.command('fragment-warmup')
+    @click.option('--endpoint', '-e', multiple=True, help='Endpoint to warm up, all by default.')
+    @click.option('--processes', '-p', default=4, help='Number of processes.')
+    @click.option('--rate', '-r', type=float, default=None, help='Max fragments per second.')
+    @click.option('--force', is_flag=True, help='Renders fresh fragments too.')
+    def fragment_warmup(endpoint, processes, rate, force):
+        """Pre-renders cached fragments into memcached."""
+        summary = fragment.warmup(endpoint or None, processes, rate, force, print_progress)
+        click.echo('rendered {0}, fresh {1}, locked {2}, failed {3}'.format(
+            summary[RENDERED], summary[FRESH], summary[LOCKED], summary[FAILED]))
+        if summary[FAILED]:
+            sys.exit(1)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_aio
+    --------------
+
+    asyncio memcached client and async mode when memcached goes away.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import asyncio
+import flask
+import pytest
+from flask_fragment import Fragment
+from flask_fragment.aio import AsyncMemcache, LoopThread
+from benchmark.server import MemcachedServer
+
+
+@pytest.fixture
+def server():
+    server = MemcachedServer()
+    server.start()
+    yield server
+    if server._loop is not None and not server._loop.is_closed():
+        server.stop()
+
+
+def test_stopped_server_is_miss(server):
+    loop = LoopThread()
+    memcache = AsyncMemcache([server.address], loop=loop)
+    assert loop.run(memcache.set('key', b'value'))
+    assert loop.run(memcache.get('key')) == b'value'
+    server.stop()
+    assert loop.run(memcache.get('key')) is None
+    assert loop.run(memcache.get_multi(['key', 'other'])) == {}
+    assert loop.run(memcache.set('key', b'value')) is False
+    assert loop.run(memcache.add('lock', 1)) is False
+    assert loop.run(memcache.delete('key')) is False
+    assert loop.run(memcache.incr('counter', 1)) is None
+    assert loop.run(memcache.pipeline([('set', 'a', b'1', 0), ('delete', 'b')])) == ['a', 'b']
+    # broken connections are not kept
+    assert not any(idle for servers in memcache._idle.values() for idle in servers.values())
+
+
+def test_async_page_without_memcached(server):
+    app = flask.Flask(__name__)
+    app.config.update(FRAGMENT_CACHING=True, FRAGMENT_ASYNC=True,
+                      FRAGMENT_MEMCACHED_SERVERS=[server.address])
+    fragment = Fragment(app)
+
+    @fragment(app, cache=300)
+    def box(n):
+        return 'box{0}'.format(n)
+
+    @app.route('/')
+    def page():
+        return flask.render_template_string("{{ fragment('box', 1) }}")
+
+    client = app.test_client()
+    assert client.get('/').status_code == 200
+    server.stop()
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b'/_inc/box/1' in response.data
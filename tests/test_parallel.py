@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_parallel
+    -------------------
+
+    Parallel mode and streamed responses.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import flask
+import pytest
+from flask_fragment import Fragment
+
+
+@pytest.fixture
+def app():
+    app = flask.Flask(__name__)
+    app.config.update(FRAGMENT_PARALLEL=True)
+    fragment = Fragment(app)
+
+    @fragment(app)
+    def box(n):
+        return 'box{0}'.format(n)
+
+    @app.route('/')
+    def page():
+        return flask.render_template_string("{{ fragment('box', 1) }}|{{ fragment('box', 2) }}")
+
+    @app.route('/stream')
+    def stream():
+        return flask.stream_template_string("{{ fragment('box', 1) }}|{{ fragment('box', 2) }}")
+
+    @app.route('/eager')
+    def eager():
+        html = flask.render_template_string("{{ fragment('box', 1) }}")
+        return flask.Response(iter([html]))
+
+    return app
+
+
+def test_placeholders_spliced(app):
+    assert app.test_client().get('/').data == b'box1|box2'
+
+
+def test_streamed_response_rendered_serially(app):
+    assert app.test_client().get('/stream').data == b'box1|box2'
+
+
+def test_placeholders_in_streamed_response_fail(app):
+    app.testing = True
+    with pytest.raises(RuntimeError):
+        app.test_client().get('/eager')
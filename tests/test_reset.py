@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_reset
+    ----------------
+
+    Counting of URL resets.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import flask
+import pytest
+from flask_fragment import Fragment
+from benchmark.server import MemcachedServer
+
+
+@pytest.fixture
+def server():
+    server = MemcachedServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_only_fresh_fragments_counted(server, bulk):
+    app = flask.Flask(__name__)
+    app.config.update(FRAGMENT_CACHING=True, FRAGMENT_MEMCACHED_SERVERS=[server.address])
+    fragment = Fragment(app)
+
+    @fragment(app, cache=300)
+    def box(n):
+        return 'box{0}'.format(n)
+
+    @app.route('/')
+    def page():
+        return flask.render_template_string("{{ fragment('box', 1) }}")
+
+    client = app.test_client()
+    with app.test_request_context():
+        stored, never_stored = flask.url_for('box', n=1), flask.url_for('box', n=2)
+    client.get('/')
+    client.get(stored)
+    with app.test_request_context():
+        for N in range(3):
+            if bulk:
+                fragment.reset_urls([stored, never_stored])
+            else:
+                fragment.reset_url(stored)
+                fragment.reset_url(never_stored)
+        assert fragment.stats.snapshot()['endpoints']['box']['resets'] == 1
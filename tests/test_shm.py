@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_shm
+    --------------
+
+    Shared memory store used by several forked processes at once.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import zlib
+import multiprocessing
+import pytest
+from flask_fragment.shm import SharedMemoryStore
+
+fork = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                          reason='needs fork start method')
+
+
+def store(path):
+    return SharedMemoryStore(str(path), size=64*1024, slot_sizes=(256,), ways=2, locks=8)
+
+
+def same_bucket(shm, count):
+    """Returns keys whose items share one bucket, spread over all stripes."""
+    buckets = shm.classes[0][3]
+    keys = []
+    N = 0
+    while len(keys) < count:
+        key = 'k{0}'.format(N)
+        if zlib.crc32(key.encode('utf-8')) % buckets == 0:
+            keys.append(key)
+        N += 1
+    return keys
+
+
+def hammer(path, keys, rounds, errors):
+    shm = store(path)
+    for N in range(rounds):
+        for key in keys:
+            shm.set(key, key+'='+'x'*100)
+            value = shm.get(key)
+            if value is not None and value.split('=')[0] != key:
+                with errors.get_lock():
+                    errors.value += 1
+
+
+def test_stripes_cover_whole_buckets(tmpdir):
+    shm = store(tmpdir.join('shm'))
+    for capacity, offset, bucket_size, buckets in shm.classes:
+        assert buckets % shm.locks == 0
+    for N in range(1000):
+        hash = zlib.crc32('k{0}'.format(N).encode('utf-8')) & 0xFFFFFFFF
+        assert shm._stripe(hash) == hash % shm.classes[0][3] % shm.locks
+
+
+@pytest.mark.parametrize('size', [64*1024*1024, 16*1024*1024, 4*1024*1024])
+def test_mapped_size_within_configured(tmpdir, size):
+    shm = SharedMemoryStore(str(tmpdir.join('shm')), size=size)
+    assert shm.size <= size
+    assert tmpdir.join('shm').size() == shm.size
+    for capacity, offset, bucket_size, buckets in shm.classes:
+        assert buckets % shm.locks == 0
+
+
+def test_size_too_small(tmpdir):
+    with pytest.raises(ValueError):
+        SharedMemoryStore(str(tmpdir.join('shm')), size=1024*1024)
+
+
+@fork
+def test_processes_sharing_bucket(tmpdir):
+    path = tmpdir.join('shm')
+    keys = same_bucket(store(path), 16)
+    context = multiprocessing.get_context('fork')
+    errors = context.Value('i', 0)
+    workers = [context.Process(target=hammer, args=(path, keys[N::4], 3000, errors))
+               for N in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert errors.value == 0
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_urls
+    ---------------
+
+    Fragment URLs built by precompiled templates and their memo.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import flask
+import pytest
+from flask_fragment import Fragment
+
+
+@pytest.mark.parametrize('memo', [False, True])
+def test_equal_arguments_of_other_types(memo):
+    app = flask.Flask(__name__)
+    app.config.update(FRAGMENT_URL_MEMO=memo)
+    fragment = Fragment(app)
+
+    @fragment(app)
+    def box(n):
+        return 'box{0}'.format(n)
+
+    with app.test_request_context():
+        for value in (1, True, 1.0, 1, True, 1.0):
+            assert fragment._url('box', box, {'n': value}) == flask.url_for('box', n=value)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_utilites
+    -------------------
+
+    Consistent hashing compatible with nginx and pipelined quiet requests.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import bmemcached
+import pytest
+from flask_fragment.utilites import KetamaRing, _send_quiet
+from benchmark.server import MemcachedServer
+
+# Servers picked by nginx `hash $key consistent` for upstream blocks
+# with the same servers, see `ngx_http_upstream_init_chash`
+LOCAL = ['127.0.0.1:11211', '127.0.0.1:11212', '127.0.0.1:11213']
+LOCAL_NODES = [
+    ('/_inc/box/1', '127.0.0.1:11213'),
+    ('/_inc/box/2', '127.0.0.1:11213'),
+    ('/_inc/posts_list/1', '127.0.0.1:11211'),
+    ('/_inc/posts_list/2', '127.0.0.1:11212'),
+    ('/_inc/post/42', '127.0.0.1:11213'),
+    ('/_inc/comments/42', '127.0.0.1:11213'),
+    ('/app/_inc/box/1', '127.0.0.1:11212'),
+    ('/_inc/%D1%84/1', '127.0.0.1:11213'),
+    ('fragment:epoch', '127.0.0.1:11211'),
+    ('a', '127.0.0.1:11212'),
+    ('', '127.0.0.1:11211'),
+    # crc32 is less than the first point
+    ('/_inc/box/454', '127.0.0.1:11211'),
+    # crc32 is greater than the last point, wraps to the first one
+    ('/_inc/box/22137', '127.0.0.1:11211'),
+]
+MIXED = ['10.0.0.1:11211', '10.0.0.2:11211', 'memcached.local:11211', 'unix:/var/run/memcached.sock']
+MIXED_WEIGHTS = {'10.0.0.2:11211': 2}
+MIXED_NODES = [
+    ('/_inc/box/1', '10.0.0.1:11211'),
+    ('/_inc/box/2', '10.0.0.2:11211'),
+    ('/_inc/posts_list/1', 'unix:/var/run/memcached.sock'),
+    ('/_inc/posts_list/2', 'memcached.local:11211'),
+    ('/_inc/post/42', 'unix:/var/run/memcached.sock'),
+    ('/_inc/comments/42', '10.0.0.1:11211'),
+    ('/app/_inc/box/1', '10.0.0.2:11211'),
+    ('/_inc/%D1%84/1', '10.0.0.2:11211'),
+    ('fragment:epoch', '10.0.0.2:11211'),
+    ('a', 'memcached.local:11211'),
+    ('', 'memcached.local:11211'),
+]
+
+
+@pytest.mark.parametrize('key, server', LOCAL_NODES)
+def test_ketama_ring_local(key, server):
+    assert KetamaRing(LOCAL).get_server(key) == server
+
+
+@pytest.mark.parametrize('key, server', MIXED_NODES)
+def test_ketama_ring_weights_and_sockets(key, server):
+    assert KetamaRing(MIXED, MIXED_WEIGHTS).get_server(key) == server
+
+
+def test_ketama_ring_points():
+    ring = KetamaRing(LOCAL, {'127.0.0.1:11212': 3})
+    assert len(ring._hashes) == 160*5
+    assert ring._hashes == sorted(ring._hashes)
+
+
+@pytest.fixture
+def server():
+    server = MemcachedServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_send_quiet_round_trip(server):
+    client = bmemcached.Client([server.address])
+    client.set('counter', 5)
+    client.set('deleted', b'value')
+    client.set('text', b'not a number')
+    protocol = client._servers[0]
+    server.reset_stats()
+    failed = _send_quiet(protocol, [('set', 'stored', b'body', 300),
+                                    ('delete', 'deleted'),
+                                    ('delete', 'missing'),
+                                    ('incr', 'counter', 2),
+                                    ('incr', 'missing counter', 1),
+                                    ('incr', 'text', 1)])
+    # missing keys are not failures, non numeric value is
+    assert failed == ['text']
+    assert server.roundtrips == 1
+    assert server.commands == 7
+    # replies are read up to noop, connection is in sync for next commands
+    assert client.get('stored') == b'body'
+    assert client.get('deleted') is None
+    assert client.get('counter') == 7
+    assert client.get('missing counter') is None
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.test_warmup
+    -----------------
+
+    Warm-up of fragments.
+
+    :copyright: (c) 2013 by Alexey Poryadin.
+    :license: MIT, see LICENSE for more details.
+"""
+import flask
+import pytest
+from flask_fragment import Fragment
+from benchmark.server import MemcachedServer
+
+
+@pytest.fixture
+def server():
+    server = MemcachedServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_failed_render_releases_lock(server):
+    app = flask.Flask(__name__)
+    app.config.update(FRAGMENT_CACHING=True, FRAGMENT_MEMCACHED_SERVERS=[server.address])
+    fragment = Fragment(app)
+    failures = [RuntimeError('database is down')]
+
+    @fragment(app, cache=300)
+    def box(n):
+        if failures:
+            raise failures.pop()
+        return 'box{0}'.format(n)
+
+    @fragment.warmup_args(box)
+    def box_args():
+        return [1]
+
+    with app.app_context():
+        summary = fragment.warmup(processes=0)
+        assert summary['failed'] == 1
+        assert not any(key.startswith(b'fragment:lock:') for key in server.data)
+        summary = fragment.warmup(processes=0)
+        assert summary['rendered'] == 1 and summary['locked'] == 0